@@ -4,12 +4,15 @@ from sqlalchemy.orm import Session
 from decouple import config
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
+from fastapi.concurrency import run_in_threadpool
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 
 from schemas.schemas import User, TokenData
 from crud.users import get_single_user
 from database.database import get_db
+from auth.passwords import verify_password_async
+from auth.cache import principal_cache
+from monitoring.timing import phase
 
 
 
@@ -17,24 +20,15 @@ SECRET_KEY = config("secret")
 ALGORITHM = config("algorithm")
 ACCESS_TOKEN_EXPIRE_MINUTES = config("access_token_expires_minutes")
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/v1/token")
 
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
-
-
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
-
-def authenticate_user(db: Session, username: str, password: str):
-    user = get_single_user(db, username)
+async def authenticate_user(db: Session, username: str, password: str):
+    '''Looks the user up in the threadpool and checks the password in the password hashing pool'''
+    user = await run_in_threadpool(get_single_user, db, username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await verify_password_async(password, user.hashed_password):
         return False
     return user
 
@@ -51,13 +45,19 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 
 
 def get_current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)):
+    '''Returns the user of the token, from the principal cache when the token was seen recently'''
+    cached_user = principal_cache.get(token)
+    if cached_user is not None:
+        return cached_user
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        with phase("jwt"):
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
@@ -67,6 +67,11 @@ def get_current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_
     user = get_single_user(db, username=token_data.username)
     if user is None:
         raise credentials_exception
+
+    # cache a copy of the user rather than the ORM instance, which belongs to this request's session
+    user = User.from_orm(user)
+    if "exp" in payload:
+        principal_cache.set(token, user, payload["exp"])
     return user
 
 
@@ -0,0 +1,58 @@
+import threading
+import time
+from collections import OrderedDict
+from decouple import config
+
+
+class PrincipalCache:
+    '''
+        Bounded LRU cache of the users authenticated by get_current_user, keyed by token.
+        An entry lives at most ttl seconds and never longer than its token.
+        Entries are only invalidated in this process, ttl bounds how stale other workers can be.
+    '''
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        # routes run in the threadpool, so the cache is shared between threads
+        self._lock = threading.Lock()
+
+    def get(self, token: str):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            user, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return user
+
+    def set(self, token: str, user, token_expires_at: float):
+        if self.max_size <= 0:
+            return
+        expires_at = min(time.time() + self.ttl, token_expires_at)
+        with self._lock:
+            self._entries[token] = (user, expires_at)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id: int):
+        '''Removes every entry of a user, to be called when the account is changed or deleted'''
+        with self._lock:
+            tokens = [token for token, (user, _) in self._entries.items() if user.id == user_id]
+            for token in tokens:
+                del self._entries[token]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+principal_cache = PrincipalCache(
+    max_size=config("AUTH_CACHE_SIZE", default=1024, cast=int),
+    ttl=config("AUTH_CACHE_TTL_SECONDS", default=60, cast=float),
+)
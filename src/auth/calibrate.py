@@ -0,0 +1,40 @@
+'''
+    Picks the bcrypt cost for a target hashing latency on the current hardware.
+    Run from the src folder: python3 -m auth.calibrate --target-ms 250
+'''
+import argparse
+import statistics
+import time
+from passlib.hash import bcrypt
+
+
+def hash_duration(rounds: int, repeat: int):
+    '''Returns the median duration of one hash with this cost, in milliseconds'''
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        bcrypt.using(rounds=rounds).hash("calibration password")
+        durations.append((time.perf_counter() - start) * 1000)
+    return statistics.median(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pick the bcrypt cost for a target latency")
+    parser.add_argument("--target-ms", type=float, default=250, help="Target duration of one hash in milliseconds")
+    parser.add_argument("--repeat", type=int, default=3, help="Hashes per cost, the median is kept")
+    args = parser.parse_args()
+
+    # bcrypt doesn't accept a cost under 4, and each extra round doubles the duration
+    chosen_rounds = 4
+    for rounds in range(4, 32):
+        duration = hash_duration(rounds, args.repeat)
+        print(f"rounds {rounds:>2}: {duration:8.1f} ms")
+        if duration > args.target_ms:
+            break
+        chosen_rounds = rounds
+
+    print(f"\nBCRYPT_ROUNDS={chosen_rounds}")
+
+
+if __name__ == "__main__":
+    main()
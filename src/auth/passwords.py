@@ -0,0 +1,41 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from decouple import config
+from passlib.context import CryptContext
+
+from monitoring.timing import phase
+
+
+# Cost of new hashes, existing hashes keep the cost they were made with. Use "python -m auth.calibrate" to pick it.
+BCRYPT_ROUNDS = config("BCRYPT_ROUNDS", default=12, cast=int)
+PASSWORD_HASHING_WORKERS = config("PASSWORD_HASHING_WORKERS", default=min(4, os.cpu_count() or 1), cast=int)
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+# bcrypt releases the GIL, so hashes run in parallel in these threads.
+# The pool is bounded: a burst of logins queues up here instead of taking the event loop
+# or every thread of FastAPI's threadpool, so cheap read routes keep being served.
+hashing_pool = ThreadPoolExecutor(max_workers=PASSWORD_HASHING_WORKERS, thread_name_prefix="password-hashing")
+
+
+def get_password_hash(password):
+    return pwd_context.hash(password)
+
+
+def verify_password(plain_password, hashed_password):
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+async def get_password_hash_async(password):
+    '''Hashes the password in the password hashing pool'''
+    loop = asyncio.get_running_loop()
+    with phase("bcrypt"):
+        return await loop.run_in_executor(hashing_pool, get_password_hash, password)
+
+
+async def verify_password_async(plain_password, hashed_password):
+    '''Verifies the password in the password hashing pool'''
+    loop = asyncio.get_running_loop()
+    with phase("bcrypt"):
+        return await loop.run_in_executor(hashing_pool, verify_password, plain_password, hashed_password)
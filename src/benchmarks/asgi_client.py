@@ -0,0 +1,53 @@
+import asyncio
+from urllib.parse import urlsplit
+
+
+async def asgi_request(app, method: str, url: str, headers: dict = None, body: bytes = b""):
+    '''
+        Sends one HTTP request straight to an ASGI app, without any network or server in between.
+        Returns the status code, the response headers and the response body.
+    '''
+    parts = urlsplit(url)
+    request_headers = [(b"host", b"testserver")]
+    request_headers += [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()]
+    if body:
+        request_headers.append((b"content-length", str(len(body)).encode()))
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method.upper(),
+        "scheme": "http",
+        "path": parts.path,
+        "raw_path": parts.path.encode(),
+        "query_string": parts.query.encode(),
+        "root_path": "",
+        "headers": request_headers,
+        "client": ("127.0.0.1", 50000),
+        "server": ("testserver", 80),
+    }
+    request_sent = False
+    response_complete = asyncio.Event()
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        # the client only disconnects once it has the whole response, streamed responses stop at a disconnect
+        await response_complete.wait()
+        return {"type": "http.disconnect"}
+
+    response = {"status": None, "headers": [], "body": []}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = [(name.decode(), value.decode()) for name, value in message.get("headers", [])]
+        elif message["type"] == "http.response.body":
+            response["body"].append(message.get("body", b""))
+            if not message.get("more_body", False):
+                response_complete.set()
+
+    await app(scope, receive, send)
+    return response["status"], dict(response["headers"]), b"".join(response["body"])
@@ -0,0 +1,78 @@
+'''
+    Measures how cheap requests behave while slow database requests run on the same worker.
+    Run from the src folder: python3 -m benchmarks.concurrency --comments 1000000
+'''
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from sqlalchemy.orm import sessionmaker
+
+from main import app
+from benchmarks.asgi_client import asgi_request
+from benchmarks.data import create_benchmark_engine, populate_comments
+from database.database import get_db
+
+
+async def worker(url: str, deadline: float, latencies: list):
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        # a real request arrives from the network, so it has to wait for the loop to be free to be handled
+        await asyncio.sleep(0)
+        status, _, _ = await asgi_request(app, "GET", url)
+        if status != 200:
+            raise RuntimeError(f"{url} answered {status}")
+        latencies.append((time.perf_counter() - start) * 1000)
+
+
+async def run(slow_workers: int, fast_workers: int, duration: float, skip: int):
+    deadline = time.perf_counter() + duration
+    slow_latencies, fast_latencies = [], []
+    slow_url = f"/api/v1/comments?skip={skip}&limit=25"
+    await asyncio.gather(
+        *[worker(slow_url, deadline, slow_latencies) for _ in range(slow_workers)],
+        *[worker("/", deadline, fast_latencies) for _ in range(fast_workers)],
+    )
+    return slow_latencies, fast_latencies
+
+
+def percentile(values: list, fraction: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cheap requests running next to slow database requests")
+    parser.add_argument("--comments", type=int, default=1_000_000, help="Number of comments to generate")
+    parser.add_argument("--slow-workers", type=int, default=4, help="Concurrent clients paging deep into comments")
+    parser.add_argument("--fast-workers", type=int, default=4, help="Concurrent clients calling the home route")
+    parser.add_argument("--duration", type=float, default=5, help="Duration of the run in seconds")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_benchmark_engine(os.path.join(directory, "benchmark.db"))
+        populate_comments(engine, args.comments)
+        SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+        def override_get_db():
+            db = SessionLocal()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        app.dependency_overrides[get_db] = override_get_db
+        slow, fast = asyncio.run(run(args.slow_workers, args.fast_workers, args.duration, args.comments // 2))
+        engine.dispose()
+
+    for name, latencies in (("deep comments page", slow), ("home", fast)):
+        print(
+            f"{name:>20}: {len(latencies) / args.duration:8.1f} req/s"
+            f"  p50 {statistics.median(latencies):7.2f} ms  p95 {percentile(latencies, 0.95):7.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import os
+import random
+from datetime import datetime
+from sqlalchemy import create_engine
+
+from database.database import Base
+from models import models  # noqa: F401, registers the tables on Base
+from crud.comments import recount_comments
+from crud.statistics import build_statistics
+from import_data import get_season_ep_number, import_characters, import_episodes, iter_records
+
+DATA_FOLDER = os.path.join(os.path.dirname(__file__), "..", "data")
+EPISODES_FILE = os.path.join(DATA_FOLDER, "rick_morty-episodes_v1.json")
+CHARACTERS_FILE = os.path.join(DATA_FOLDER, "rick_morty-characters_v1.json")
+AIR_DATE_FORMAT = "%B %d, %Y"
+
+
+# Words the generated comments are made of, common ones first so that searches have a realistic spread of matches
+WORDS = (
+    "the", "episode", "rick", "morty", "was", "great", "funny", "portal", "gun", "summer", "beth", "jerry",
+    "citadel", "squanch", "pickle", "council", "dimension", "szechuan", "sauce", "meeseeks", "unity", "birdperson",
+    "evil", "schwifty", "plumbus", "gazorpazorp", "cronenberg", "tiny", "froopyland", "wubba", "lubba", "dub",
+)
+WORD_WEIGHTS = [1 / (rank + 1) for rank in range(len(WORDS))]
+
+
+def create_benchmark_engine(path: str):
+    '''Returns an engine on a new SQLite database file with all the tables created'''
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    return engine
+
+
+def populate_comments(
+    engine,
+    count: int,
+    episodes: int = 51,
+    characters: int = 671,
+    users: int = 1000,
+    seed: int = 0,
+    batch_size: int = 50000
+):
+    '''Inserts count deterministic comments spread over episodes, characters and users, and indexes their content'''
+    rng = random.Random(seed)
+    with engine.begin() as connection:
+        for start in range(0, count, batch_size):
+            rows = [
+                (
+                    " ".join(rng.choices(WORDS, WORD_WEIGHTS, k=8)),
+                    rng.randint(1, episodes),
+                    rng.randint(1, characters),
+                    rng.randint(1, users),
+                )
+                for _ in range(start, min(count, start + batch_size))
+            ]
+            connection.exec_driver_sql(
+                "INSERT INTO comments (content, episode_id, character_id, user_id) VALUES (?, ?, ?, ?)",
+                rows
+            )
+        connection.exec_driver_sql("INSERT INTO comments_fts(comments_fts) VALUES ('rebuild')")
+
+
+def scaled_episodes(count: int):
+    '''
+        Yields count episode records: the episodes of the data folder, then copies of them in the following seasons,
+        aired after the previous copy
+    '''
+    real = list(iter_records(EPISODES_FILE))
+    seasons = max(get_season_ep_number(episode["episode"])[0] for episode in real)
+    air_dates = [datetime.strptime(episode["air_date"], AIR_DATE_FORMAT) for episode in real]
+    span = max(air_dates) - min(air_dates)
+    for index in range(count):
+        copy, position = divmod(index, len(real))
+        episode = real[position]
+        if copy == 0:
+            yield episode
+            continue
+        season, number = get_season_ep_number(episode["episode"])
+        yield dict(
+            episode,
+            id=episode["id"] + copy * len(real),
+            name=f"{episode['name']} {copy + 1}",
+            air_date=(air_dates[position] + copy * span).strftime(AIR_DATE_FORMAT),
+            episode=f"S{season + copy * seasons:02d}E{number:02d}",
+        )
+
+
+def scaled_characters(count: int, episodes: int, seed: int = 0):
+    '''
+        Yields count character records: the characters of the data folder, then copies of them.
+        A copy appears in as many episodes as its original, the same episodes of a random copy of the episodes.
+    '''
+    rng = random.Random(seed)
+    real = list(iter_records(CHARACTERS_FILE))
+    real_episodes = sum(1 for _ in iter_records(EPISODES_FILE))
+    episode_copies = max(1, episodes // real_episodes)
+    for index in range(count):
+        copy, position = divmod(index, len(real))
+        character = real[position]
+        shift = 0 if copy == 0 else rng.randrange(episode_copies) * real_episodes
+        yield dict(
+            character,
+            id=character["id"] + copy * len(real),
+            name=character["name"] if copy == 0 else f"{character['name']} {copy + 1}",
+            episode=[episode + shift for episode in character["episode"] if episode + shift <= episodes],
+        )
+
+
+def populate_users(engine, count: int, batch_size: int = 50000):
+    '''Inserts count users named user1, user2... that can't log in, their password hash is empty'''
+    with engine.begin() as connection:
+        for start in range(1, count + 1, batch_size):
+            connection.exec_driver_sql(
+                "INSERT INTO users (username, email, hashed_password, disabled) VALUES (?, ?, '', 0)",
+                [(f"user{i}", f"user{i}@example.com") for i in range(start, min(count + 1, start + batch_size))]
+            )
+
+
+def populate_dataset(engine, episodes: int, characters: int, users: int, comments: int, seed: int = 0):
+    '''
+        Fills a new database with a Rick & Morty dataset scaled to the given sizes, the same for the same arguments,
+        with its comment counts and statistics up to date like after an import
+    '''
+    import_episodes(scaled_episodes(episodes), 10000, bind=engine)
+    import_characters(scaled_characters(characters, episodes, seed), 10000, bind=engine)
+    populate_users(engine, users)
+    populate_comments(engine, comments, episodes, characters, users, seed)
+    with engine.begin() as connection:
+        recount_comments(connection)
+        build_statistics(connection)
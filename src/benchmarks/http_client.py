@@ -0,0 +1,48 @@
+import asyncio
+from urllib.parse import urlsplit
+
+
+def decode_chunked(content: bytes):
+    '''Returns the body of a response sent with Transfer-Encoding: chunked'''
+    body = []
+    while content:
+        size_line, _, content = content.partition(b"\r\n")
+        size = int(size_line.split(b";")[0], 16)
+        if size == 0:
+            break
+        body.append(content[:size])
+        content = content[size + 2:]
+    return b"".join(body)
+
+
+async def http_request(base_url: str, method: str, url: str, headers: dict = None, body: bytes = b""):
+    '''
+        Sends one HTTP/1.1 request to a server on a new connection, closed by the server after the response.
+        Returns the status code, the response headers and the response body, like asgi_request.
+    '''
+    parts = urlsplit(base_url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    try:
+        lines = [
+            f"{method.upper()} {url} HTTP/1.1",
+            f"Host: {parts.netloc}",
+            "Connection: close",
+            f"Content-Length: {len(body)}",
+        ]
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+        # the server closes the connection once the whole response is sent
+        response = await reader.read()
+    finally:
+        writer.close()
+
+    head, _, content = response.partition(b"\r\n\r\n")
+    status_line, *header_lines = head.decode("latin-1").split("\r\n")
+    response_headers = {}
+    for line in header_lines:
+        name, _, value = line.partition(":")
+        response_headers[name.strip().lower()] = value.strip()
+    if response_headers.get("transfer-encoding") == "chunked":
+        content = decode_chunked(content)
+    return int(status_line.split()[1]), response_headers, content
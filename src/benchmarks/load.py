@@ -0,0 +1,279 @@
+'''
+    Load test: concurrent clients run a weighted mix of scenarios, reads, logins, comment writes and exports,
+    and the throughput, latency percentiles and error rate of each scenario are reported.
+    The app is driven in-process, on a generated dataset, or a running server with --url.
+    Run from the src folder: python3 -m benchmarks.load --mix mixed --concurrency 32 --duration 10
+    Exits with 1 when the error rate is above --max-error-rate.
+'''
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from functools import partial
+from urllib.parse import urlencode
+from sqlalchemy.orm import sessionmaker
+
+from main import app
+from benchmarks.asgi_client import asgi_request
+from benchmarks.concurrency import percentile
+from benchmarks.data import create_benchmark_engine, populate_dataset
+from benchmarks.http_client import http_request
+from benchmarks.suite import SIZES
+from database.database import create_configured_engine, get_db
+from database.settings import PROFILES, EngineSettings
+
+# Weight of every scenario in a mix, as "read=80,write=20" on the command line
+MIXES = {
+    "reads": {"read": 1},
+    "mixed": {"read": 85, "write": 10, "login": 4, "export": 1},
+    "writes": {"read": 50, "write": 50},
+    "logins": {"read": 50, "login": 50},
+}
+
+# Reads pick one of these urls, the first episodes and users always exist
+READ_URLS = (
+    "/api/v1/episodes",
+    "/api/v1/episodes?cursor=",
+    "/api/v1/episodes?include=characters&limit=10",
+    "/api/v1/characters?episode_name=pilot",
+    "/api/v1/characters?status=alive&cursor=",
+    "/api/v1/comments?cursor=",
+    "/api/v1/comments?episode_id=1",
+    "/api/v1/comments?q=portal%20gun",
+    "/api/v1/users?sort=-comment_count",
+    "/api/v1/stats/characters/species",
+    "/",
+)
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+FORM_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+
+
+def parse_mix(mix: str):
+    '''Returns the scenario weights of a mix name or of a "scenario=weight,..." list'''
+    if mix in MIXES:
+        return MIXES[mix]
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        if name.strip() not in SCENARIOS:
+            raise ValueError(f"Unknown scenario {name}, available scenarios are {', '.join(SCENARIOS)}")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+class Account:
+    '''A user created for the load test, with its password to log in and a token to write comments'''
+
+    def __init__(self, username: str, password: str):
+        self.username = username
+        self.password = password
+        self.token = None
+
+    def login_body(self):
+        return urlencode({"username": self.username, "password": self.password}).encode()
+
+
+async def login(send, account: Account):
+    status, _, body = await send("POST", "/api/v1/token", FORM_HEADERS, account.login_body())
+    if status == 200:
+        account.token = json.loads(body)["access_token"]
+    return status
+
+
+async def create_accounts(send, count: int):
+    '''Signs up count new users and logs them in, usernames are unique to the run so a server can be loaded again'''
+    run = f"{int(time.time() * 1000):x}"
+    accounts = [Account(f"load_{run}_{i}", f"password {i}") for i in range(count)]
+
+    async def sign_up(account: Account):
+        body = {"id": 0, "username": account.username, "email": f"{account.username}@example.com",
+                "password": account.password}
+        status, _, response = await send("POST", "/api/v1/signup", JSON_HEADERS, json.dumps(body).encode())
+        if status != 201:
+            raise RuntimeError(f"Could not sign up {account.username}: {status} {response[:200]}")
+        if await login(send, account) != 200:
+            raise RuntimeError(f"Could not log {account.username} in")
+
+    await asyncio.gather(*[sign_up(account) for account in accounts])
+    return accounts
+
+
+async def read(send, rng: random.Random, accounts: list):
+    status, _, _ = await send("GET", rng.choice(READ_URLS))
+    return status
+
+
+async def log_in(send, rng: random.Random, accounts: list):
+    return await login(send, rng.choice(accounts))
+
+
+async def write(send, rng: random.Random, accounts: list):
+    account = rng.choice(accounts)
+    # user_id is required by the schema, the comment is written for the user of the token
+    body = {"content": f"load test comment {rng.random()}", "episode_id": rng.randint(1, 51), "user_id": 0}
+    headers = dict(JSON_HEADERS, Authorization=f"Bearer {account.token}")
+    status, _, _ = await send("POST", "/api/v1/comments", headers, json.dumps(body).encode())
+    return status
+
+
+async def export(send, rng: random.Random, accounts: list):
+    status, _, _ = await send("GET", "/api/v1/comments/export_csv")
+    return status
+
+
+SCENARIOS = {"read": read, "login": log_in, "write": write, "export": export}
+
+
+class ScenarioStats:
+    def __init__(self):
+        self.latencies = []
+        self.statuses = Counter()
+        self.errors = 0
+
+    def add(self, status, elapsed_ms: float):
+        self.latencies.append(elapsed_ms)
+        self.statuses[status] += 1
+        if status == "error" or status >= 400:
+            self.errors += 1
+
+    def summary(self, duration: float):
+        latencies = self.latencies or [0.0]
+        return {
+            "requests": len(self.latencies),
+            "throughput": len(self.latencies) / duration,
+            "error_rate": self.errors / max(1, len(self.latencies)),
+            "p50_ms": percentile(latencies, 0.5),
+            "p95_ms": percentile(latencies, 0.95),
+            "p99_ms": percentile(latencies, 0.99),
+            "max_ms": max(latencies),
+            "statuses": {str(status): count for status, count in self.statuses.items()},
+        }
+
+
+async def client(send, weights: dict, accounts: list, deadline: float, stats: dict, seed: int):
+    '''One client running scenarios picked by weight one after the other until the deadline'''
+    rng = random.Random(seed)
+    names, cumulative_weights = list(weights), []
+    for name in names:
+        cumulative_weights.append((cumulative_weights[-1] if cumulative_weights else 0) + weights[name])
+    while time.perf_counter() < deadline:
+        name = rng.choices(names, cum_weights=cumulative_weights)[0]
+        start = time.perf_counter()
+        try:
+            status = await SCENARIOS[name](send, rng, accounts)
+        except Exception:
+            # connection errors, or the exception of a 500 in-process
+            status = "error"
+        stats[name].add(status, (time.perf_counter() - start) * 1000)
+        # a client waits for the loop like a request coming from the network would
+        await asyncio.sleep(0)
+
+
+async def monitor_loop_lag(deadline: float, lags: list, interval: float = 0.01):
+    '''Measures how late the event loop wakes up a sleeping task, the time it spent blocked by something else'''
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append((time.perf_counter() - start - interval) * 1000)
+
+
+async def run(send, weights: dict, concurrency: int, duration: float, users: int, seed: int, in_process: bool):
+    accounts = await create_accounts(send, users)
+    stats = {name: ScenarioStats() for name in weights}
+    lags = []
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    tasks = [client(send, weights, accounts, deadline, stats, seed + index) for index in range(concurrency)]
+    if in_process:
+        # the clients share the loop of the app in-process, so the lag is the time requests blocked it
+        tasks.append(monitor_loop_lag(deadline, lags))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    report = {"scenarios": {name: scenario.summary(elapsed) for name, scenario in stats.items()}}
+    total = ScenarioStats()
+    for scenario in stats.values():
+        total.latencies += scenario.latencies
+        total.statuses += scenario.statuses
+        total.errors += scenario.errors
+    report["total"] = total.summary(elapsed)
+    if lags:
+        report["loop_lag"] = {"p50_ms": percentile(lags, 0.5), "p99_ms": percentile(lags, 0.99), "max_ms": max(lags)}
+    return report
+
+
+def print_report(report: dict):
+    print(f"{'scenario':<10} {'requests':>9} {'req/s':>9} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, summary in list(report["scenarios"].items()) + [("total", report["total"])]:
+        print(
+            f"{name:<10} {summary['requests']:>9} {summary['throughput']:>9.1f} {summary['error_rate']:>7.1%}"
+            f" {summary['p50_ms']:>9.2f} {summary['p95_ms']:>9.2f} {summary['p99_ms']:>9.2f}"
+        )
+    if "loop_lag" in report:
+        lag = report["loop_lag"]
+        print(f"Event loop lag: p50 {lag['p50_ms']:.2f} ms, p99 {lag['p99_ms']:.2f} ms, max {lag['max_ms']:.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the app with a mix of concurrent scenarios")
+    parser.add_argument("--url", help="Base url of a running server, the app is driven in-process without it")
+    parser.add_argument("--mix", default="mixed", help=f"One of {', '.join(MIXES)} or weights like read=80,write=20")
+    parser.add_argument("--concurrency", type=int, default=16, help="Number of concurrent clients")
+    parser.add_argument("--duration", type=float, default=10, help="Duration of the run in seconds")
+    parser.add_argument("--users", type=int, default=8, help="Number of users signed up to log in and write")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the scenario choices and generated dataset")
+    parser.add_argument("--size", choices=SIZES, default="small", help="Size of the dataset generated in-process")
+    parser.add_argument("--database", help="Database file to reuse in-process, generated first if it doesn't exist")
+    parser.add_argument("--profile", choices=PROFILES, default="production", help="Database profile in-process")
+    parser.add_argument("--max-error-rate", type=float, default=0.01, help="Error rate above which the run fails")
+    parser.add_argument("--output", help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    try:
+        weights = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.url:
+        send = partial(http_request, args.url)
+        report = asyncio.run(run(send, weights, args.concurrency, args.duration, args.users, args.seed, False))
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            path = args.database or os.path.join(directory, "load.db")
+            if not os.path.exists(path):
+                engine = create_benchmark_engine(path)
+                print(f"Generating the {args.size} dataset with seed {args.seed}")
+                populate_dataset(engine, **SIZES[args.size], seed=args.seed)
+                engine.dispose()
+            engine = create_configured_engine(EngineSettings(args.profile, f"sqlite:///{path}"))
+            SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+            def override_get_db():
+                db = SessionLocal()
+                try:
+                    yield db
+                finally:
+                    db.close()
+
+            app.dependency_overrides[get_db] = override_get_db
+            send = partial(asgi_request, app)
+            report = asyncio.run(run(send, weights, args.concurrency, args.duration, args.users, args.seed, True))
+            engine.dispose()
+
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if report["total"]["error_rate"] > args.max_error_rate:
+        print(f"Error rate above {args.max_error_rate:.1%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+'''
+    Compares offset and cursor pagination of get_comments at increasing page depths.
+    Run from the src folder: python3 -m benchmarks.pagination --comments 1000000
+'''
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.data import create_benchmark_engine, populate_comments
+from crud.comments import get_comments
+from crud.pagination import encode_cursor
+
+
+def time_call(function, repeat: int):
+    '''Returns the median duration of function in milliseconds'''
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append((time.perf_counter() - start) * 1000)
+    return statistics.median(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offset against cursor pagination")
+    parser.add_argument("--comments", type=int, default=1_000_000, help="Number of comments to generate")
+    parser.add_argument("--limit", type=int, default=25, help="Page size")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measure, the median is kept")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_benchmark_engine(os.path.join(directory, "benchmark.db"))
+        print(f"Generating {args.comments} comments")
+        populate_comments(engine, args.comments)
+        SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        db = SessionLocal()
+
+        print(f"{'page':>10} {'offset (ms)':>12} {'cursor (ms)':>12}")
+        for depth in (0, 0.01, 0.1, 0.5, 0.99):
+            skip = int(args.comments * depth) // args.limit * args.limit
+            # ids are contiguous, so the cursor of a page is the id of the last row of the previous one
+            cursor = encode_cursor([skip]) if skip else ""
+
+            offset_ms = time_call(lambda: get_comments(db, skip, args.limit), args.repeat)
+            cursor_ms = time_call(lambda: get_comments(db, limit=args.limit, cursor=cursor), args.repeat)
+            print(f"{skip // args.limit + 1:>10} {offset_ms:>12.2f} {cursor_ms:>12.2f}")
+
+        db.close()
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+'''
+    Measures full text search of comments.
+    Run from the src folder: python3 -m benchmarks.search --comments 1000000
+'''
+import argparse
+import os
+import tempfile
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.data import create_benchmark_engine, populate_comments
+from benchmarks.pagination import time_call
+from crud.comments import get_comments
+
+# from a word in most comments to a combination of rare words
+QUERIES = ("the", "rick portal", "meeseeks", "schwifty plumbus", "wubba lubba dub", "gazorpazorp froopyland")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark full text search of comments")
+    parser.add_argument("--comments", type=int, default=1_000_000, help="Number of comments to generate")
+    parser.add_argument("--limit", type=int, default=25, help="Page size")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measure, the median is kept")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_benchmark_engine(os.path.join(directory, "benchmark.db"))
+        print(f"Generating {args.comments} comments")
+        populate_comments(engine, args.comments)
+        SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        db = SessionLocal()
+
+        print(f"{'query':>25} {'results':>8} {'search (ms)':>12}")
+        for q in QUERIES:
+            results = len(get_comments(db, limit=args.limit, q=q))
+            search_ms = time_call(lambda: get_comments(db, limit=args.limit, q=q), args.repeat)
+            print(f"{q:>25} {results:>8} {search_ms:>12.2f}")
+
+        db.close()
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+'''
+    Compares the serialization of list pages through the response_model of their route, as FastAPI does for ORM
+    instances, with plain rows encoded by orjson as the routes do now.
+    Run from the src folder: python3 -m benchmarks.serialization --limit 25
+'''
+import argparse
+import os
+import tempfile
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.data import create_benchmark_engine, populate_comments
+from benchmarks.pagination import time_call
+from crud import characters, comments, episodes, users
+from crud.pagination import paginate
+from import_data import import_characters, import_episodes, iter_records
+from main import app, rows_response
+from models.models import Character, Comment, Episode, User
+
+DATA_FOLDER = os.path.join(os.path.dirname(__file__), "..", "data")
+
+# Route, model loaded by the old path, and crud function and columns of the new one
+ENDPOINTS = (
+    ("/api/v1/episodes", Episode, episodes.get_episodes, episodes.COLUMNS),
+    ("/api/v1/characters", Character, characters.get_characters, characters.COLUMNS),
+    ("/api/v1/comments", Comment, comments.get_comments, comments.COLUMNS),
+    ("/api/v1/users", User, users.get_user, users.COLUMNS),
+)
+
+
+def orm_response(db, route, model, limit):
+    '''Loads ORM instances and validates them through the response_model of the route before encoding them'''
+    rows = paginate(db.query(model), 0, limit).all()
+    value, errors = route.response_field.validate(rows, {}, loc=("response",))
+    assert not errors
+    return JSONResponse(jsonable_encoder(value))
+
+
+def rows_response_of(db, function, columns, limit):
+    return rows_response(Response(), function(db, limit=limit), columns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark response_model serialization against plain rows")
+    parser.add_argument("--limit", type=int, default=25, help="Page size")
+    parser.add_argument("--repeat", type=int, default=200, help="Runs per measure, the median is kept")
+    args = parser.parse_args()
+
+    routes = {route.path: route for route in app.routes if "GET" in getattr(route, "methods", ())}
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_benchmark_engine(os.path.join(directory, "benchmark.db"))
+        import_episodes(iter_records(os.path.join(DATA_FOLDER, "rick_morty-episodes_v1.json")), 1000, bind=engine)
+        import_characters(iter_records(os.path.join(DATA_FOLDER, "rick_morty-characters_v1.json")), 1000, bind=engine)
+        populate_comments(engine, 10000)
+        with engine.begin() as connection:
+            connection.exec_driver_sql(
+                "INSERT INTO users (username, email, hashed_password, disabled) VALUES (?, ?, '', 0)",
+                [(f"user{i}", f"user{i}@example.com") for i in range(1000)]
+            )
+        SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        db = SessionLocal()
+
+        print(f"{'route':<20} {'response_model (ms)':>20} {'rows (ms)':>10} {'speedup':>8}")
+        for path, model, function, columns in ENDPOINTS:
+            route = routes[path]
+            # both paths must send the same JSON
+            assert orm_response(db, route, model, args.limit).body == rows_response_of(db, function, columns, args.limit).body
+            orm_ms = time_call(lambda: orm_response(db, route, model, args.limit), args.repeat)
+            rows_ms = time_call(lambda: rows_response_of(db, function, columns, args.limit), args.repeat)
+            print(f"{path:<20} {orm_ms:>20.3f} {rows_ms:>10.3f} {orm_ms / rows_ms:>7.1f}x")
+
+        db.close()
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+'''
+    Runs every list endpoint and crud function on a generated dataset and records their throughput and latency
+    percentiles, then compares them with a stored baseline.
+    Run from the src folder: python3 -m benchmarks.suite --size small
+    Exits with 1 when a benchmark got slower than its baseline by more than the threshold.
+'''
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+
+from main import app
+from auth.auth_handler import create_access_token
+from benchmarks.asgi_client import asgi_request
+from benchmarks.concurrency import percentile
+from benchmarks.data import create_benchmark_engine, populate_dataset
+from crud import characters, comments, episodes, relations, statistics, users
+from database.database import create_configured_engine, get_db
+from database.settings import PROFILES, EngineSettings
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# Sizes of the generated datasets, every one can be changed on the command line
+SIZES = {
+    "small": {"episodes": 51, "characters": 671, "users": 1000, "comments": 100_000},
+    "medium": {"episodes": 510, "characters": 6710, "users": 10_000, "comments": 1_000_000},
+    "large": {"episodes": 1020, "characters": 50_000, "users": 100_000, "comments": 10_000_000},
+}
+
+# Name of the benchmark and url requested from the app, with the dataset sizes to format it
+REQUESTS = (
+    ("GET /api/v1/episodes", "/api/v1/episodes"),
+    ("GET /api/v1/episodes cursor", "/api/v1/episodes?cursor="),
+    ("GET /api/v1/episodes include characters", "/api/v1/episodes?include=characters"),
+    ("GET /api/v1/characters", "/api/v1/characters"),
+    ("GET /api/v1/characters by episode name", "/api/v1/characters?episode_name=pilot"),
+    ("GET /api/v1/comments", "/api/v1/comments"),
+    ("GET /api/v1/comments deep offset", "/api/v1/comments?skip={comments_middle}"),
+    ("GET /api/v1/comments cursor", "/api/v1/comments?cursor="),
+    ("GET /api/v1/comments by episode", "/api/v1/comments?episode_id=1"),
+    ("GET /api/v1/comments search", "/api/v1/comments?q=szechuan%20sauce"),
+    ("GET /api/v1/comments ids", "/api/v1/comments?ids=1,10,100,1000"),
+    ("GET /api/v1/users", "/api/v1/users"),
+    ("GET /api/v1/users sorted by comments", "/api/v1/users?sort=-comment_count"),
+    ("GET /api/v1/users/me/comments", "/api/v1/users/me/comments"),
+    ("GET /api/v1/stats/episodes", "/api/v1/stats/episodes"),
+    ("GET /api/v1/stats/characters/species", "/api/v1/stats/characters/species"),
+)
+
+# Name of the benchmark and crud call on a session
+CALLS = (
+    ("episodes.get_episodes by season", lambda db: episodes.get_episodes(db, season_number="1")),
+    ("characters.get_characters by species", lambda db: characters.get_characters(db, species="Human")),
+    ("comments.get_comments by user", lambda db: comments.get_comments(db, user_id=1)),
+    ("comments.get_comments search", lambda db: comments.get_comments(db, q="portal gun")),
+    ("users.get_single_user", lambda db: users.get_single_user(db, username="user1")),
+    ("relations.get_episodes_characters", lambda db: relations.get_episodes_characters(db, list(range(1, 26)))),
+    ("statistics.get_character_distribution", lambda db: statistics.get_character_distribution(db, "species")),
+)
+
+
+def dataset_of(engine):
+    '''Returns the number of rows of the tables the benchmarks depend on'''
+    with engine.connect() as connection:
+        return {
+            table_name: connection.execute(text(f"SELECT count(*) FROM {table_name}")).scalar()
+            for table_name in ("episodes", "characters", "appearances", "users", "comments")
+        }
+
+
+async def measure(call, duration: float, min_runs: int, warmup: int = 3):
+    '''Runs an async call again and again for duration seconds, and at least min_runs times'''
+    for _ in range(warmup):
+        await call()
+    latencies = []
+    start = time.perf_counter()
+    while len(latencies) < min_runs or time.perf_counter() - start < duration:
+        call_start = time.perf_counter()
+        await call()
+        latencies.append((time.perf_counter() - call_start) * 1000)
+    elapsed = time.perf_counter() - start
+    return {
+        "runs": len(latencies),
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.5),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+    }
+
+
+async def run(SessionLocal, dataset: dict, duration: float, min_runs: int, selected: str = None):
+    results = {}
+    auth_header = {"Authorization": "Bearer " + create_access_token({"sub": "user1"})}
+
+    def requester(url: str):
+        async def call():
+            status, _, _ = await asgi_request(app, "GET", url, headers=auth_header)
+            if status != 200:
+                raise RuntimeError(f"{url} answered {status}")
+        return call
+
+    def caller(function):
+        async def call():
+            db = SessionLocal()
+            try:
+                function(db)
+            finally:
+                db.close()
+        return call
+
+    urls = {"comments_middle": dataset["comments"] // 2}
+    benchmarks = [(name, requester(url.format(**urls))) for name, url in REQUESTS]
+    benchmarks += [(name, caller(function)) for name, function in CALLS]
+    for name, call in benchmarks:
+        if selected and selected not in name:
+            continue
+        results[name] = await measure(call, duration, min_runs)
+        result = results[name]
+        print(
+            f"{name:<45} {result['throughput']:9.1f} ops/s  p50 {result['p50_ms']:8.2f} ms"
+            f"  p95 {result['p95_ms']:8.2f} ms  p99 {result['p99_ms']:8.2f} ms"
+        )
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float):
+    '''
+        Returns the benchmarks slower than in the baseline by more than threshold, a fraction:
+        their median latency went up or their throughput went down by more than it
+    '''
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            continue
+        if result["p50_ms"] > reference["p50_ms"] * (1 + threshold):
+            regressions.append(f"{name}: p50 {reference['p50_ms']:.2f} ms -> {result['p50_ms']:.2f} ms")
+        elif result["throughput"] < reference["throughput"] / (1 + threshold):
+            regressions.append(
+                f"{name}: throughput {reference['throughput']:.1f} -> {result['throughput']:.1f} ops/s"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the endpoints and crud functions against a baseline")
+    parser.add_argument("--size", choices=SIZES, default="small", help="Size of the generated dataset")
+    for name in SIZES["small"]:
+        parser.add_argument(f"--{name}", type=int, help=f"Number of {name}, instead of the one of --size")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated dataset")
+    parser.add_argument("--database", help="Database file to reuse, generated first if it doesn't exist")
+    parser.add_argument("--profile", choices=PROFILES, default="production", help="Database profile of the app")
+    parser.add_argument("--duration", type=float, default=1, help="Seconds each benchmark runs")
+    parser.add_argument("--min-runs", type=int, default=20, help="Minimum number of runs of each benchmark")
+    parser.add_argument("--only", help="Only run the benchmarks whose name contains this")
+    parser.add_argument("--baseline", default=BASELINE, help="Baseline results to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="Write the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Slowdown ratio counted as a regression")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    sizes = {name: getattr(args, name) or size for name, size in SIZES[args.size].items()}
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.database or os.path.join(directory, "benchmark.db")
+        generate = not os.path.exists(path)
+        engine = create_benchmark_engine(path)
+        if generate:
+            print(f"Generating {sizes} with seed {args.seed}")
+            populate_dataset(engine, **sizes, seed=args.seed)
+        dataset = dataset_of(engine)
+        engine.dispose()
+        print(f"Dataset: {dataset}")
+
+        # the app is benchmarked with the engine, pool and pragmas of a database profile
+        engine = create_configured_engine(EngineSettings(args.profile, f"sqlite:///{path}"))
+
+        SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+        def override_get_db():
+            db = SessionLocal()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        app.dependency_overrides[get_db] = override_get_db
+        results = asyncio.run(run(SessionLocal, dataset, args.duration, args.min_runs, args.only))
+        engine.dispose()
+
+    report = {"dataset": dataset, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved the baseline to {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline to record one")
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline["dataset"] != dataset:
+        parser.error(f"the baseline was recorded on another dataset: {baseline['dataset']}")
+    regressions = compare(results, baseline["results"], args.threshold)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    if regressions:
+        sys.exit(1)
+    print(f"No regression above {args.threshold:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
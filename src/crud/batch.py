@@ -0,0 +1,39 @@
+from decouple import config
+from fastapi import HTTPException
+from sqlalchemy import case
+
+# Most ids a list route accepts in one "ids" parameter
+MAX_BATCH_SIZE = config("MAX_BATCH_SIZE", default=100, cast=int)
+
+
+def parse_ids(ids: str = None, cursor: str = None):
+    '''Returns the ids of a comma separated list without duplicates and in their first order, None without list'''
+    if ids is None:
+        return None
+    if cursor is not None:
+        raise HTTPException(
+            status_code=400,
+            detail="Rows fetched by ids are not paged, they can't be combined with a cursor",
+        )
+    try:
+        id_list = list(dict.fromkeys(int(id_) for id_ in ids.split(",") if id_.strip()))
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail="ids must be a comma separated list of integers",
+        )
+    if len(id_list) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_BATCH_SIZE} ids can be fetched at once",
+        )
+    return id_list
+
+
+def by_ids(query, id_column, id_list: list):
+    '''Filters a query on a list of ids in a single IN query, rows come back in the order of the list'''
+    if not id_list:
+        return query.filter(False)
+    return query.filter(id_column.in_(id_list)).order_by(
+        case({id_: position for position, id_ in enumerate(id_list)}, value=id_column)
+    )
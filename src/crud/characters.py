@@ -1,6 +1,22 @@
 from sqlalchemy.orm import Session
 
-from models.models import Character, StatusEnum, GenderEnum, Episode, Appearance
+from models.models import Character, StatusEnum, GenderEnum, Episode, Appearance, normalize_name
+from crud.pagination import paginate, sort_order
+from crud.fields import select_columns, parse_include
+from crud.batch import parse_ids, by_ids
+from crud import reference_data
+
+# Columns of schemas.Character, list queries select them as plain rows instead of loading Character instances
+COLUMNS = (
+    Character.id, Character.name, Character.status, Character.species, Character.character_type, Character.gender
+)
+CURSOR_COLUMNS = (Character.id,)
+# Columns only selected when they are asked for in fields
+OPTIONAL_COLUMNS = (Character.comment_count,)
+# Fields the characters can be sorted by
+SORTS = {"comment_count": Character.comment_count}
+# Relations that can be embedded in the characters with include
+RELATIONS = ("episodes",)
 
 def get_characters(
     db: Session,
@@ -10,10 +26,27 @@ def get_characters(
     species: str = None,
     character_type: str = None,
     gender: GenderEnum = None,
-    episode_name = None
-
+    episode_name = None,
+    cursor: str = None,
+    fields: str = None,
+    ids: str = None,
+    include: str = None,
+    sort: str = None
 ):
-    query = db.query(Character)
+    id_list = parse_ids(ids, cursor)
+    order = sort_order(sort, SORTS, Character.id, cursor) if sort else None
+    # related rows are loaded by the id of the characters
+    required = (Character.id,) if parse_include(include, RELATIONS) else ()
+    columns = select_columns(COLUMNS, fields, cursor, CURSOR_COLUMNS, required, OPTIONAL_COLUMNS)
+    # comment counts change with every comment, the in-memory reference data only holds imported columns
+    counted = order or any(column.key == "comment_count" for column in columns)
+    store = None if counted else reference_data.current(db)
+    if store is not None:
+        return store.get_characters(
+            skip, limit, status, species, character_type, gender, episode_name, cursor, id_list
+        )
+
+    query = db.query(*columns)
     if status:
         query = query.filter(Character.status == status.value)
     if species:
@@ -23,10 +56,16 @@ def get_characters(
     if gender:
         query = query.filter(Character.gender == gender.value)
     if episode_name:
-        # Get episode id corresponding to the episode name sent (case insensitive search)
-        episode_id_query = db.query(Episode.id).filter(Episode.title.ilike(episode_name))
+        # Get episode id corresponding to the episode name sent (case insensitive search on an indexed column)
+        episode_id_query = db.query(Episode.id).filter(Episode.title_normalized == normalize_name(episode_name))
         
-        # Join Characters with Episodes with condition that episode_id is right
-        query = query.join(Character.episode.and_(Appearance.episode_id.in_(episode_id_query)))
+        # Keep the characters appearing in one of these episodes, a join would repeat a character for
+        # every matching episode and shorten the pages
+        character_id_query = db.query(Appearance.character_id).filter(Appearance.episode_id.in_(episode_id_query))
+        query = query.filter(Character.id.in_(character_id_query))
 
-    return query.offset(skip).limit(limit).all()
\ No newline at end of file
+    if id_list is not None:
+        return by_ids(query, Character.id, id_list).all()
+    if order:
+        query = query.order_by(*order)
+    return paginate(query, skip, limit, cursor, CURSOR_COLUMNS).all()
\ No newline at end of file
@@ -1,24 +1,126 @@
+import csv
+import io
+from collections import Counter, namedtuple
+from decouple import config
+from sqlalchemy import insert, literal_column, text
 from sqlalchemy.orm import Session
+from fastapi import HTTPException
 
-from models.models import Comment, User
+from models.models import Character, Comment, Episode, User, comments_fts
 from schemas.schemas import CommentCreate, User
+from crud.pagination import paginate
+from crud.fields import select_columns
+from crud.batch import parse_ids, by_ids
+from crud.versions import bump_versions, version_cache
+
+# Columns of schemas.Comment, list queries select them as plain rows instead of loading Comment instances
+COLUMNS = (Comment.episode_id, Comment.character_id, Comment.content, Comment.user_id, Comment.id)
+CURSOR_COLUMNS = (Comment.id,)
+# Tables holding a comment_count and the comment column referencing them
+COUNTERS = {"episodes": "episode_id", "characters": "character_id", "users": "user_id"}
+# Most comments created by one request to the batch route
+MAX_COMMENT_BATCH = config("MAX_COMMENT_BATCH", default=1000, cast=int)
+# Most matches of a search that are ranked, the newest ones, so a common word doesn't rank every comment
+SEARCH_CANDIDATES = config("SEARCH_CANDIDATES", default=1000, cast=int)
+MISSING_TARGET = "Episode ID or Character ID is required to create a comment"
+
+NewComment = namedtuple("NewComment", ["content", "episode_id", "character_id", "user_id"])
+
+
+def search_query(q: str):
+    '''Turns a user search into an FTS5 query matching every word, so FTS5 syntax characters can't break it'''
+    return " ".join('"{}"'.format(word.replace('"', '""')) for word in q.split())
+
+
+def index_comments(db: Session, comments: list):
+    '''Adds the content of comments, (id, content) pairs, to the search index in one statement'''
+    db.execute(
+        text("INSERT INTO comments_fts(rowid, content) VALUES (:id, :content)"),
+        [{"id": comment_id, "content": content} for comment_id, content in comments]
+    )
+
+
+def index_comment(db: Session, comment_id: int, content: str):
+    index_comments(db, [(comment_id, content)])
+
+
+def unindex_comment(db: Session, comment_id: int, content: str):
+    # external content FTS5 tables need the indexed content to remove a row
+    db.execute(
+        text("INSERT INTO comments_fts(comments_fts, rowid, content) VALUES ('delete', :id, :content)"),
+        {"id": comment_id, "content": content}
+    )
+
+
+def count_comments(db: Session, comments: list, delta: int):
+    '''
+        Adds delta to the comment counts of the episodes, characters and users of comments, in the caller transaction.
+        Every row is updated once, with one statement per table.
+    '''
+    for table_name, column in COUNTERS.items():
+        counts = Counter(getattr(comment, column) for comment in comments if getattr(comment, column) is not None)
+        if counts:
+            db.execute(
+                text(f"UPDATE {table_name} SET comment_count = comment_count + :delta WHERE id = :id"),
+                [{"delta": delta * count, "id": id_} for id_, count in counts.items()]
+            )
+
+
+def count_comment(db: Session, comment, delta: int):
+    '''Adds delta to the comment counts of the episode, character and user of a comment, in the caller transaction'''
+    count_comments(db, [comment], delta)
+
+
+def recount_comments(connection, table_names: tuple = tuple(COUNTERS)):
+    '''Recomputes the comment counts of whole tables from the comments, each count is read from an index'''
+    for table_name in table_names:
+        connection.execute(text(
+            f"UPDATE {table_name} SET comment_count = "
+            f"(SELECT count(*) FROM comments WHERE comments.{COUNTERS[table_name]} = {table_name}.id)"
+        ))
+
 
 def get_comments(db: Session,
     skip: int = 0,
     limit: int = 25,
     episode_id: int = None,
     character_id: int = None,
-    user_id: int = None
+    user_id: int = None,
+    cursor: str = None,
+    q: str = None,
+    fields: str = None,
+    ids: str = None
 ):
-    query = db.query(Comment)
+    id_list = parse_ids(ids, cursor)
+    query = db.query(*select_columns(COLUMNS, fields, cursor, CURSOR_COLUMNS))
     if episode_id:
         query = query.filter(Comment.episode_id == episode_id)
     if character_id:
         query = query.filter(Comment.character_id == character_id)
     if user_id:
         query = query.filter(Comment.user_id == user_id)
+    if q and q.split():
+        if cursor is not None:
+            raise HTTPException(
+                status_code=400,
+                detail="Search results are ranked by relevance, page them with skip and limit",
+            )
+        # Full text search, best matches first among the newest matches.
+        # FTS5 reads the matches in rowid order and only scores the ones it returns,
+        # while ordering every match by rank would score and sort all of them.
+        candidates = (
+            query.join(comments_fts, comments_fts.c.rowid == Comment.id)
+            .filter(literal_column("comments_fts").op("MATCH")(search_query(q)))
+            .with_entities(comments_fts.c.rowid.label("id"), comments_fts.c.rank.label("rank"))
+            .order_by(comments_fts.c.rowid.desc())
+            .limit(max(SEARCH_CANDIDATES, skip + limit))
+            .subquery("candidates")
+        )
+        query = query.join(candidates, candidates.c.id == Comment.id).order_by(candidates.c.rank)
 
-    return query.offset(skip).limit(limit).all()
+    if id_list is not None:
+        return by_ids(query, Comment.id, id_list).all()
+    return paginate(query, skip, limit, cursor, CURSOR_COLUMNS).all()
 
 
 def create_comment(db: Session, comment: CommentCreate, current_user: User):
@@ -30,31 +132,142 @@ def create_comment(db: Session, comment: CommentCreate, current_user: User):
         user_id=current_user.id
     )
     db.add(db_comment)
+    db.flush()
+    index_comment(db, db_comment.id, db_comment.content)
+    count_comment(db, db_comment, 1)
+    bump_versions(db, "comments")
     db.commit()
+    version_cache.invalidate()
     db.refresh(db_comment)
 
     return db_comment
 
 
-def update_comment(db: Session, comment_id: int, comment: CommentCreate):
+def existing_ids(db: Session, id_column, ids: set):
+    if not ids:
+        return set()
+    return {id_ for id_, in db.query(id_column).filter(id_column.in_(ids))}
 
-    update = (
-        db.query(Comment)
-        .filter(Comment.id == comment_id)
-        .update({Comment.content: comment.content})
+
+def validate_comments(db: Session, comments: list):
+    '''
+        Checks every comment of a batch, already parsed by its schema, before any is written.
+        The episodes and characters they reference are looked up with one query per table.
+        Returns the valid comments with their index in the batch, and the errors of the others.
+    '''
+    errors = []
+    parsed = []
+    for index, comment in enumerate(comments):
+        if not comment.episode_id and not comment.character_id:
+            errors.append({"index": index, "detail": MISSING_TARGET})
+            continue
+        parsed.append((index, comment))
+
+    episode_ids = existing_ids(db, Episode.id, {comment.episode_id for _, comment in parsed if comment.episode_id})
+    character_ids = existing_ids(
+        db, Character.id, {comment.character_id for _, comment in parsed if comment.character_id}
     )
+    valid = []
+    for index, comment in parsed:
+        if comment.episode_id and comment.episode_id not in episode_ids:
+            errors.append({"index": index, "detail": f"Episode {comment.episode_id} does not exist"})
+        elif comment.character_id and comment.character_id not in character_ids:
+            errors.append({"index": index, "detail": f"Character {comment.character_id} does not exist"})
+        else:
+            valid.append((index, comment))
+    return valid, sorted(errors, key=lambda error: error["index"])
+
+
+def create_comments(db: Session, comments: list, current_user: User):
+    '''
+        Creates the valid comments of a batch for the current user, in one transaction.
+        Returns the ids of the created comments and the errors of the invalid ones, by index in the batch.
+    '''
+    if not comments:
+        raise HTTPException(status_code=400, detail="No comments to create")
+    if len(comments) > MAX_COMMENT_BATCH:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_COMMENT_BATCH} comments can be created at once",
+        )
+
+    valid, errors = validate_comments(db, comments)
+    if not valid:
+        return {"created": [], "errors": errors}
+
+    new_comments = [
+        NewComment(comment.content, comment.episode_id, comment.character_id, current_user.id)
+        for _, comment in valid
+    ]
+    # SQLite only tells the id of the last row of an insert, and doesn't promise the ids of a multi-row insert
+    # follow its rows, so every row is inserted on its own to read its id. They all share one transaction and commit.
+    statement = insert(Comment.__table__)
+    ids = [db.execute(statement, comment._asdict()).inserted_primary_key[0] for comment in new_comments]
+    index_comments(db, [(id_, comment.content) for id_, comment in zip(ids, new_comments)])
+    count_comments(db, new_comments, 1)
+    bump_versions(db, "comments")
     db.commit()
-    if not update:
+    version_cache.invalidate()
+
+    created = [{"index": index, "id": id_} for (index, _), id_ in zip(valid, ids)]
+    return {"created": created, "errors": errors}
+
+
+def update_comment(db: Session, comment_id: int, comment: CommentCreate):
+
+    old_comment = db.query(Comment.content).filter(Comment.id == comment_id).first()
+    if not old_comment:
         return None
 
+    db.query(Comment).filter(Comment.id == comment_id).update({Comment.content: comment.content})
+    unindex_comment(db, comment_id, old_comment.content)
+    index_comment(db, comment_id, comment.content)
+    bump_versions(db, "comments")
+    db.commit()
+    version_cache.invalidate()
+
     return db.query(Comment).filter(Comment.id == comment_id).first()
 
 
 def delete_comment(db: Session, comment_id: int):
 
+    old_comment = db.query(
+        Comment.content, Comment.episode_id, Comment.character_id, Comment.user_id
+    ).filter(Comment.id == comment_id).first()
+    if not old_comment:
+        return None
+
     deletion = db.query(Comment).filter(Comment.id == comment_id).delete()
+    unindex_comment(db, comment_id, old_comment.content)
+    count_comment(db, old_comment, -1)
+    bump_versions(db, "comments")
     db.commit()
-    if not deletion:
-        return None
+    version_cache.invalidate()
+
+    return deletion
+
+
+def export_comments_csv(db: Session, chunk_size: int = 1000):
+    '''
+        Yields all the comments as CSV text, one chunk of rows at a time.
+        Rows are fetched by ascending id so memory stays flat whatever the size of the table.
+    '''
+    columns = [Comment.id, Comment.content, Comment.episode_id, Comment.character_id, Comment.user_id]
+    stream = io.StringIO()
+    writer = csv.writer(stream)
+    writer.writerow([column.key for column in columns])
+
+    last_id = None
+    while True:
+        query = db.query(*columns)
+        if last_id is not None:
+            query = query.filter(Comment.id > last_id)
+        rows = query.order_by(Comment.id).limit(chunk_size).all()
+        if not rows:
+            break
+        writer.writerows(rows)
+        last_id = rows[-1].id
 
-    return deletion
\ No newline at end of file
+        yield stream.getvalue()
+        stream.seek(0)
+        stream.truncate(0)
@@ -1,7 +1,22 @@
 from sqlalchemy.orm import Session
 from sqlalchemy import Date
 
-from models.models import Episode, Appearance, Character
+from models.models import Episode, Appearance, Character, normalize_name
+from crud.pagination import paginate, sort_order
+from crud.fields import select_columns, parse_include
+from crud.batch import parse_ids, by_ids
+from crud import reference_data
+
+# Columns of schemas.Episode, list queries select them as plain rows instead of loading Episode instances
+COLUMNS = (Episode.id, Episode.title, Episode.air_date, Episode.episode_number, Episode.season_number)
+# Episodes are paged by air date in cursor mode, id keeps the order stable between episodes aired the same day
+CURSOR_COLUMNS = (Episode.air_date, Episode.id)
+# Columns only selected when they are asked for in fields
+OPTIONAL_COLUMNS = (Episode.comment_count,)
+# Fields the episodes can be sorted by
+SORTS = {"comment_count": Episode.comment_count}
+# Relations that can be embedded in the episodes with include
+RELATIONS = ("characters",)
 
 
 def get_episodes(
@@ -12,10 +27,28 @@ def get_episodes(
     after_air_date: Date = None,
     episode_number: int = None,
     season_number: str = None,
-    character_name: str = None
-
+    character_name: str = None,
+    cursor: str = None,
+    fields: str = None,
+    ids: str = None,
+    include: str = None,
+    sort: str = None
 ):
-    query = db.query(Episode)
+    id_list = parse_ids(ids, cursor)
+    order = sort_order(sort, SORTS, Episode.id, cursor) if sort else None
+    # related rows are loaded by the id of the episodes
+    required = (Episode.id,) if parse_include(include, RELATIONS) else ()
+    columns = select_columns(COLUMNS, fields, cursor, CURSOR_COLUMNS, required, OPTIONAL_COLUMNS)
+    # comment counts change with every comment, the in-memory reference data only holds imported columns
+    counted = order or any(column.key == "comment_count" for column in columns)
+    store = None if counted else reference_data.current(db)
+    if store is not None:
+        return store.get_episodes(
+            skip, limit, before_air_date, after_air_date, episode_number, season_number, character_name, cursor,
+            id_list
+        )
+
+    query = db.query(*columns)
     if before_air_date:
         query = query.filter(Episode.air_date < before_air_date)
     if after_air_date:
@@ -26,10 +59,16 @@ def get_episodes(
         query = query.filter(Episode.season_number == season_number)
         # Search for episodes where a certain character is in
     if character_name:
-        # Get character id corresponding to the character name sent (case insensitive search)
-        character_id_query = db.query(Character.id).filter(Character.name.ilike(character_name))
+        # Get character id corresponding to the character name sent (case insensitive search on an indexed column)
+        character_id_query = db.query(Character.id).filter(Character.name_normalized == normalize_name(character_name))
         
-        # Join Episodes with Characters with condition that character_id is right
-        query = query.join(Episode.character.and_(Appearance.character_id.in_(character_id_query)))
+        # Keep the episodes where one of these characters appears, a join would repeat an episode for
+        # every matching character and shorten the pages
+        episode_id_query = db.query(Appearance.episode_id).filter(Appearance.character_id.in_(character_id_query))
+        query = query.filter(Episode.id.in_(episode_id_query))
        
-    return query.offset(skip).limit(limit).all()
\ No newline at end of file
+    if id_list is not None:
+        return by_ids(query, Episode.id, id_list).all()
+    if order:
+        query = query.order_by(*order)
+    return paginate(query, skip, limit, cursor, CURSOR_COLUMNS).all()
\ No newline at end of file
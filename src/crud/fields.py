@@ -0,0 +1,53 @@
+from fastapi import HTTPException
+
+
+def field_names(columns: tuple, fields: str = None, optional: tuple = ()):
+    '''
+        Returns the names of the fields asked for in a comma separated list, all the columns when the list is empty.
+        Optional columns are only returned when they are asked for.
+    '''
+    # a list of separators only, like "," or " , ", is empty as well
+    names = [name.strip() for name in (fields or "").split(",") if name.strip()]
+    if not names:
+        return [column.key for column in columns]
+    available = [column.key for column in columns + optional]
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown fields {', '.join(unknown)}, available fields are {', '.join(available)}",
+        )
+    return [name for name in available if name in names]
+
+
+def select_columns(
+    columns: tuple,
+    fields: str = None,
+    cursor: str = None,
+    cursor_columns: tuple = (),
+    required: tuple = (),
+    optional: tuple = ()
+):
+    '''
+        Returns the columns to select for the fields asked for, and the required ones.
+        In cursor mode the cursor columns are selected as well, the cursor of the next page is read from them.
+    '''
+    names = field_names(columns, fields, optional)
+    if cursor is not None:
+        required = tuple(cursor_columns) + tuple(required)
+    names += [column.key for column in required if column.key not in names]
+    return [column for column in columns + optional if column.key in names]
+
+
+def parse_include(include: str, relations: tuple):
+    '''Returns the relations asked for in a comma separated list, checked against the ones available'''
+    if not include:
+        return []
+    names = list(dict.fromkeys(name.strip() for name in include.split(",") if name.strip()))
+    unknown = [name for name in names if name not in relations]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown relations {', '.join(unknown)}, available relations are {', '.join(relations)}",
+        )
+    return names
@@ -0,0 +1,106 @@
+import base64
+import binascii
+import json
+from datetime import date
+from fastapi import HTTPException
+from sqlalchemy import Date, Integer, and_, or_
+
+
+def encode_cursor(values: list):
+    '''Returns an opaque cursor string from the keyset values of the last row of a page'''
+    values = [value.isoformat() if isinstance(value, date) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_value(value, column):
+    '''Converts a cursor value to the type of its column, raises ValueError if it can't hold it'''
+    if value is None:
+        if not column.nullable:
+            raise ValueError
+        return None
+    if isinstance(column.type, Integer):
+        # bool is an int for Python but not a valid id
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError
+        return value
+    if not isinstance(value, str):
+        raise ValueError
+    if isinstance(column.type, Date):
+        return date.fromisoformat(value)
+    return value
+
+
+def decode_cursor(cursor: str, columns: tuple):
+    '''Returns the keyset values stored in a cursor, converted to the types of the columns'''
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError
+        return [decode_value(value, column) for value, column in zip(values, columns)]
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid pagination cursor",
+        )
+
+
+def paginate(query, skip: int, limit: int, cursor: str = None, cursor_columns: tuple = None):
+    '''
+        Applies pagination to a query.
+        Without cursor, rows are paged with offset/limit.
+        With a cursor (an empty string asks for the first page), rows are ordered by the cursor columns
+        and only those after the cursor position are fetched, so page N costs the same as page 1.
+    '''
+    if cursor is None:
+        return query.offset(skip).limit(limit)
+
+    query = query.order_by(*cursor_columns)
+    if cursor:
+        values = decode_cursor(cursor, cursor_columns)
+        query = query.filter(_after(cursor_columns, values))
+
+    return query.limit(limit)
+
+
+def sort_order(sort: str, sorts: dict, id_column, cursor: str = None):
+    '''
+        Returns the ORDER BY clauses of a sort parameter, a field name ascending or "-" and a field name descending.
+        The id breaks ties in the same direction, so an index on the sorted column serves the whole order.
+    '''
+    descending = sort.startswith("-")
+    name = sort[1:] if descending else sort
+    if name not in sorts:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown sort {name}, rows can be sorted by {', '.join(sorts)}",
+        )
+    if cursor is not None:
+        raise HTTPException(
+            status_code=400,
+            detail="Sorted rows are paged with skip and limit, they can't be combined with a cursor",
+        )
+    if descending:
+        return [sorts[name].desc(), id_column.desc()]
+    return [sorts[name], id_column]
+
+
+def next_cursor(rows: list, limit: int, cursor_columns: tuple):
+    '''Returns the cursor of the page following rows, or None if rows is the last page'''
+    if len(rows) < limit or not rows:
+        return None
+    last_row = rows[-1]
+    return encode_cursor([getattr(last_row, column.key) for column in cursor_columns])
+
+
+def _after(columns: tuple, values: list):
+    # (a, b) > (x, y) is written as a > x OR (a = x AND b > y) to stay portable.
+    # NULL comes first in SQLite's ascending order: every value is after a NULL, and nothing is after a value but
+    # greater values, which a > x already leaves NULL out of.
+    column, value = columns[0], values[0]
+    if value is None:
+        if len(columns) == 1:
+            return column.isnot(None)
+        return or_(column.isnot(None), and_(column.is_(None), _after(columns[1:], values[1:])))
+    if len(columns) == 1:
+        return column > value
+    return or_(column > value, and_(column == value, _after(columns[1:], values[1:])))
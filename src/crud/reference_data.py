@@ -0,0 +1,320 @@
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from datetime import date
+from decouple import config
+from sqlalchemy.orm import Session
+
+from models.models import Episode, Character, Appearance, normalize_name
+from crud import versions
+from crud.pagination import decode_cursor
+
+# Episodes, characters and appearances only change when import_data runs, so they can be served from memory
+ENABLED = config("REFERENCE_DATA_IN_MEMORY", default=False, cast=bool)
+# How often the version of the reference tables is checked to reload them after an import
+CHECK_SECONDS = config("REFERENCE_DATA_CHECK_SECONDS", default=5, cast=float)
+
+EpisodeRow = namedtuple("EpisodeRow", ["id", "title", "air_date", "episode_number", "season_number"])
+CharacterRow = namedtuple("CharacterRow", ["id", "name", "status", "species", "character_type", "gender"])
+
+EMPTY = array("l")
+
+
+def build_index(values):
+    '''Returns an index of a column: every value with the array of the positions holding it, in ascending order'''
+    index = {}
+    for position, value in enumerate(values):
+        index.setdefault(value, array("l")).append(position)
+    return index
+
+
+def build_adjacency(pairs):
+    adjacency = {}
+    for key, value in pairs:
+        adjacency.setdefault(key, array("l")).append(value)
+    return adjacency
+
+
+def intersect(total: int, filters: list):
+    '''Returns the ascending positions matching every filter, a filter being the ascending positions it matches'''
+    if not filters:
+        return range(total)
+    filters = sorted(filters, key=len)
+    positions = filters[0]
+    for other in filters[1:]:
+        other = set(other)
+        positions = [position for position in positions if position in other]
+    return positions
+
+
+def in_order(positions, all_ids, ids: list):
+    '''Sorts positions in the order of their ids in a list'''
+    order = {id_: index for index, id_ in enumerate(ids)}
+    return sorted(positions, key=lambda position: order[all_ids[position]])
+
+
+def episode_order_key(air_date, episode_id):
+    # same order as ORDER BY air_date, id in SQLite, where NULL comes first
+    if air_date is None:
+        return (0, date.min, episode_id)
+    return (1, air_date, episode_id)
+
+
+class ReferenceData:
+    '''
+        Episodes, characters and appearances held in memory as column arrays in id order,
+        with an index for every filter of get_episodes and get_characters and the appearances in both directions
+    '''
+
+    def __init__(self, episodes: list, characters: list, appearances: list, version):
+        self.version = version
+
+        self.episode_ids = array("l", (episode.id for episode in episodes))
+        self.episode_titles = [episode.title for episode in episodes]
+        self.episode_air_dates = [episode.air_date for episode in episodes]
+        self.episode_numbers = [episode.episode_number for episode in episodes]
+        self.season_numbers = [episode.season_number for episode in episodes]
+        self.episodes_by_title = build_index(episode.title_normalized for episode in episodes)
+        self.episodes_by_number = build_index(self.episode_numbers)
+        self.episodes_by_season = build_index(self.season_numbers)
+        # positions of the episodes with an air date, sorted by air date for range filters
+        dated = sorted(
+            (air_date, position) for position, air_date in enumerate(self.episode_air_dates) if air_date is not None
+        )
+        self.dated_air_dates = [air_date for air_date, _ in dated]
+        self.dated_positions = array("l", (position for _, position in dated))
+        # cursor pagination order of the episodes, with the key of every rank to bisect a cursor
+        # and the rank of every position to order filtered positions
+        self.episode_order = sorted(
+            range(len(episodes)),
+            key=lambda position: episode_order_key(self.episode_air_dates[position], self.episode_ids[position])
+        )
+        self.episode_order_keys = [
+            episode_order_key(self.episode_air_dates[position], self.episode_ids[position])
+            for position in self.episode_order
+        ]
+        self.episode_ranks = array("l", bytes(len(episodes) * array("l").itemsize))
+        for rank, position in enumerate(self.episode_order):
+            self.episode_ranks[position] = rank
+
+        self.character_ids = array("l", (character.id for character in characters))
+        self.character_names = [character.name for character in characters]
+        self.character_statuses = [character.status for character in characters]
+        self.character_species = [character.species for character in characters]
+        self.character_types = [character.character_type for character in characters]
+        self.character_genders = [character.gender for character in characters]
+        self.characters_by_name = build_index(character.name_normalized for character in characters)
+        self.characters_by_status = build_index(self.character_statuses)
+        self.characters_by_species = build_index(self.character_species)
+        self.characters_by_type = build_index(self.character_types)
+        self.characters_by_gender = build_index(self.character_genders)
+
+        self.characters_of_episode = build_adjacency(appearances)
+        self.episodes_of_character = build_adjacency((c, e) for e, c in appearances)
+
+    @classmethod
+    def load(cls, db: Session, version):
+        episodes = db.query(
+            Episode.id, Episode.title, Episode.title_normalized, Episode.air_date,
+            Episode.episode_number, Episode.season_number
+        ).order_by(Episode.id).all()
+        characters = db.query(
+            Character.id, Character.name, Character.name_normalized, Character.status,
+            Character.species, Character.character_type, Character.gender
+        ).order_by(Character.id).all()
+        appearances = [tuple(row) for row in db.query(Appearance.episode_id, Appearance.character_id)]
+        return cls(episodes, characters, appearances, version)
+
+    def positions_of(self, ids, all_ids):
+        '''Returns the ascending positions of the ids that exist, all_ids being sorted'''
+        positions = []
+        for id_ in set(ids):
+            position = bisect_left(all_ids, id_)
+            if position < len(all_ids) and all_ids[position] == id_:
+                positions.append(position)
+        return sorted(positions)
+
+    def episode_row(self, position):
+        return EpisodeRow(
+            self.episode_ids[position],
+            self.episode_titles[position],
+            self.episode_air_dates[position],
+            self.episode_numbers[position],
+            self.season_numbers[position],
+        )
+
+    def character_row(self, position):
+        return CharacterRow(
+            self.character_ids[position],
+            self.character_names[position],
+            self.character_statuses[position],
+            self.character_species[position],
+            self.character_types[position],
+            self.character_genders[position],
+        )
+
+    def get_episodes(
+        self,
+        skip: int = 0,
+        limit: int = 25,
+        before_air_date: date = None,
+        after_air_date: date = None,
+        episode_number: int = None,
+        season_number: str = None,
+        character_name: str = None,
+        cursor: str = None,
+        ids: list = None
+    ):
+        '''Same filters and pagination as crud.episodes.get_episodes'''
+        filters = []
+        if before_air_date or after_air_date:
+            start = bisect_right(self.dated_air_dates, after_air_date) if after_air_date else 0
+            end = bisect_left(self.dated_air_dates, before_air_date) if before_air_date else len(self.dated_air_dates)
+            filters.append(sorted(self.dated_positions[start:end]))
+        if episode_number:
+            filters.append(self.episodes_by_number.get(episode_number, EMPTY))
+        if season_number:
+            try:
+                filters.append(self.episodes_by_season.get(int(season_number), EMPTY))
+            except ValueError:
+                filters.append(EMPTY)
+        if character_name:
+            character_ids = [
+                self.character_ids[position]
+                for position in self.characters_by_name.get(normalize_name(character_name), EMPTY)
+            ]
+            episode_ids = [
+                episode_id
+                for character_id in character_ids
+                for episode_id in self.episodes_of_character.get(character_id, EMPTY)
+            ]
+            filters.append(self.positions_of(episode_ids, self.episode_ids))
+        if ids is not None:
+            filters.append(self.positions_of(ids, self.episode_ids))
+        positions = intersect(len(self.episode_ids), filters)
+
+        if ids is not None:
+            return [self.episode_row(position) for position in in_order(positions, self.episode_ids, ids)]
+
+        if cursor is None:
+            return [self.episode_row(position) for position in positions[skip:skip + limit]]
+
+        from crud.episodes import CURSOR_COLUMNS
+        # ranks of the matching episodes in the cursor order, only the filtered ones are sorted
+        ranks = sorted(self.episode_ranks[position] for position in positions) if filters else range(len(positions))
+        start = 0
+        if cursor:
+            after = episode_order_key(*decode_cursor(cursor, CURSOR_COLUMNS))
+            start = bisect_left(ranks, bisect_right(self.episode_order_keys, after))
+        return [self.episode_row(self.episode_order[rank]) for rank in ranks[start:start + limit]]
+
+    def episodes_characters(self, episode_ids: list):
+        '''Returns the characters of episodes by episode id, like crud.relations.get_episodes_characters'''
+        related = {}
+        for episode_id in set(episode_ids):
+            positions = self.positions_of(self.characters_of_episode.get(episode_id, EMPTY), self.character_ids)
+            related[episode_id] = [self.character_row(position)._asdict() for position in positions]
+        return related
+
+    def characters_episodes(self, character_ids: list):
+        '''Returns the episodes of characters by character id, like crud.relations.get_characters_episodes'''
+        related = {}
+        for character_id in set(character_ids):
+            positions = self.positions_of(self.episodes_of_character.get(character_id, EMPTY), self.episode_ids)
+            related[character_id] = [self.episode_row(position)._asdict() for position in positions]
+        return related
+
+    def get_characters(
+        self,
+        skip: int = 0,
+        limit: int = 20,
+        status=None,
+        species: str = None,
+        character_type: str = None,
+        gender=None,
+        episode_name: str = None,
+        cursor: str = None,
+        ids: list = None
+    ):
+        '''Same filters and pagination as crud.characters.get_characters'''
+        filters = []
+        if status:
+            filters.append(self.characters_by_status.get(status, EMPTY))
+        if species:
+            filters.append(self.characters_by_species.get(species, EMPTY))
+        if character_type:
+            filters.append(self.characters_by_type.get(character_type, EMPTY))
+        if gender:
+            filters.append(self.characters_by_gender.get(gender, EMPTY))
+        if episode_name:
+            episode_ids = [
+                self.episode_ids[position]
+                for position in self.episodes_by_title.get(normalize_name(episode_name), EMPTY)
+            ]
+            character_ids = [
+                character_id
+                for episode_id in episode_ids
+                for character_id in self.characters_of_episode.get(episode_id, EMPTY)
+            ]
+            filters.append(self.positions_of(character_ids, self.character_ids))
+        if ids is not None:
+            filters.append(self.positions_of(ids, self.character_ids))
+        positions = intersect(len(self.character_ids), filters)
+
+        if ids is not None:
+            return [self.character_row(position) for position in in_order(positions, self.character_ids, ids)]
+
+        if cursor is None:
+            return [self.character_row(position) for position in positions[skip:skip + limit]]
+
+        from crud.characters import CURSOR_COLUMNS
+        start = 0
+        if cursor:
+            after_id, = decode_cursor(cursor, CURSOR_COLUMNS)
+            # positions are in id order
+            start = bisect_left(positions, bisect_right(self.character_ids, after_id))
+        return [self.character_row(position) for position in positions[start:start + limit]]
+
+
+_store = None
+_checked_at = 0.0
+_reload_lock = threading.Lock()
+
+
+def load_consistent(db: Session):
+    '''Loads the reference data, again if an import finished while it was loading'''
+    version = versions.reference_version(db)
+    while True:
+        store = ReferenceData.load(db, version)
+        loaded_version, version = version, versions.reference_version(db)
+        if version == loaded_version:
+            return store
+
+
+def current(db: Session):
+    '''
+        Returns the reference data loaded in memory, or None if the in-memory mode is off.
+        The version of the tables is checked every CHECK_SECONDS and the data reloaded when an import changed it.
+        A reload builds new structures and swaps them in one assignment, requests never see half loaded data.
+    '''
+    global _store, _checked_at
+    if not ENABLED:
+        return None
+
+    store = _store
+    if store is not None and time.monotonic() - _checked_at < CHECK_SECONDS:
+        return store
+
+    # a single thread checks and reloads, the others go on with the loaded data meanwhile
+    if not _reload_lock.acquire(blocking=store is None):
+        return store
+    try:
+        if _store is None or time.monotonic() - _checked_at >= CHECK_SECONDS:
+            if _store is None or versions.reference_version(db) != _store.version:
+                _store = load_consistent(db)
+            _checked_at = time.monotonic()
+        return _store
+    finally:
+        _reload_lock.release()
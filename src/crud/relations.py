@@ -0,0 +1,44 @@
+from collections import defaultdict
+from sqlalchemy.orm import Session
+
+from models.models import Appearance
+from crud import characters, episodes, reference_data
+
+# Ids per IN query, under the limit of variables in one SQLite statement
+CHUNK_SIZE = 500
+
+
+def load_related(db: Session, columns: tuple, owner_column, related_column, ids: list):
+    '''
+        Returns the rows related to ids through the appearances, grouped by owner id.
+        Rows are loaded for all the ids at once, one query per chunk of ids whatever the number of owners.
+    '''
+    related = defaultdict(list)
+    ids = list(dict.fromkeys(ids))
+    for start in range(0, len(ids), CHUNK_SIZE):
+        query = (
+            db.query(owner_column, *columns)
+            .select_from(columns[0].class_)
+            .join(Appearance, related_column == columns[0])
+            .filter(owner_column.in_(ids[start:start + CHUNK_SIZE]))
+            .order_by(owner_column, columns[0])
+        )
+        for row in query:
+            related[row[0]].append(dict(zip((column.key for column in columns), row[1:])))
+    return related
+
+
+def get_episodes_characters(db: Session, episode_ids: list):
+    '''Returns the characters of episodes by episode id'''
+    store = reference_data.current(db)
+    if store is not None:
+        return store.episodes_characters(episode_ids)
+    return load_related(db, characters.COLUMNS, Appearance.episode_id, Appearance.character_id, episode_ids)
+
+
+def get_characters_episodes(db: Session, character_ids: list):
+    '''Returns the episodes of characters by character id'''
+    store = reference_data.current(db)
+    if store is not None:
+        return store.characters_episodes(character_ids)
+    return load_related(db, episodes.COLUMNS, Appearance.character_id, Appearance.episode_id, character_ids)
@@ -0,0 +1,75 @@
+from fastapi import HTTPException
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from models.models import EpisodeStatistics, SeasonStatistics, CharacterStatistics, CharacterDistribution
+from crud.batch import parse_ids, by_ids
+
+# Character columns with a distribution
+DISTRIBUTION_FIELDS = ("status", "gender", "species")
+
+# Statements rebuilding the statistics tables, the aggregations only run here
+STATISTICS_QUERIES = {
+    "episode_statistics": (
+        "INSERT INTO episode_statistics (episode_id, character_count) "
+        "SELECT episodes.id, count(appearances.character_id) FROM episodes "
+        "LEFT JOIN appearances ON appearances.episode_id = episodes.id GROUP BY episodes.id"
+    ),
+    "season_statistics": (
+        "INSERT INTO season_statistics (season_number, episode_count) "
+        "SELECT season_number, count(*) FROM episodes WHERE season_number IS NOT NULL GROUP BY season_number"
+    ),
+    "character_statistics": (
+        "INSERT INTO character_statistics (character_id, episode_count) "
+        "SELECT characters.id, count(appearances.episode_id) FROM characters "
+        "LEFT JOIN appearances ON appearances.character_id = characters.id GROUP BY characters.id"
+    ),
+    "character_distributions": (
+        "INSERT INTO character_distributions (field, value, character_count) "
+        + " UNION ALL ".join(
+            # NULL and '' are the same value, grouped together so they make a single row
+            f"SELECT '{field}', coalesce({field}, ''), count(*) FROM characters GROUP BY coalesce({field}, '')"
+            for field in DISTRIBUTION_FIELDS
+        )
+    ),
+}
+
+
+def build_statistics(connection):
+    '''Replaces the content of the statistics tables, in the transaction of the caller'''
+    for table_name, query in STATISTICS_QUERIES.items():
+        connection.execute(text(f"DELETE FROM {table_name}"))
+        connection.execute(text(query))
+
+
+def get_episode_statistics(db: Session, skip: int = 0, limit: int = 25, ids: str = None):
+    id_list = parse_ids(ids)
+    query = db.query(EpisodeStatistics.episode_id, EpisodeStatistics.character_count)
+    if id_list is not None:
+        return by_ids(query, EpisodeStatistics.episode_id, id_list).all()
+    return query.order_by(EpisodeStatistics.episode_id).offset(skip).limit(limit).all()
+
+
+def get_season_statistics(db: Session):
+    return db.query(SeasonStatistics.season_number, SeasonStatistics.episode_count).order_by(
+        SeasonStatistics.season_number
+    ).all()
+
+
+def get_character_statistics(db: Session, skip: int = 0, limit: int = 25, ids: str = None):
+    id_list = parse_ids(ids)
+    query = db.query(CharacterStatistics.character_id, CharacterStatistics.episode_count)
+    if id_list is not None:
+        return by_ids(query, CharacterStatistics.character_id, id_list).all()
+    return query.order_by(CharacterStatistics.character_id).offset(skip).limit(limit).all()
+
+
+def get_character_distribution(db: Session, field: str):
+    if field not in DISTRIBUTION_FIELDS:
+        raise HTTPException(
+            status_code=404,
+            detail=f"No distribution of {field}, available distributions are {', '.join(DISTRIBUTION_FIELDS)}",
+        )
+    return db.query(CharacterDistribution.value, CharacterDistribution.character_count).filter(
+        CharacterDistribution.field == field
+    ).order_by(CharacterDistribution.value).all()
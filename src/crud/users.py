@@ -1,26 +1,43 @@
 from sqlalchemy.orm import Session
-from passlib.context import CryptContext
 from fastapi import HTTPException
 
 from models.models import User
 from schemas.schemas import UserCreate, UserUpdate
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-def get_password_hash(password):
-    return pwd_context.hash(password)
+from crud.pagination import paginate, sort_order
+from crud.fields import select_columns
+from crud.batch import parse_ids, by_ids
+from auth.passwords import get_password_hash
+from auth.cache import principal_cache
+
+# Columns of schemas.User, list queries select them as plain rows instead of loading User instances
+COLUMNS = (User.id, User.username, User.email, User.disabled)
+CURSOR_COLUMNS = (User.id,)
+# Columns only selected when they are asked for in fields
+OPTIONAL_COLUMNS = (User.comment_count,)
+# Fields the users can be sorted by
+SORTS = {"comment_count": User.comment_count}
 
 def get_user(
     db: Session,
     skip: int = 0,
     limit: int = 25,
-    username: str = None
+    username: str = None,
+    cursor: str = None,
+    fields: str = None,
+    ids: str = None,
+    sort: str = None
 ):
-    query = db.query(User)
+    id_list = parse_ids(ids, cursor)
+    order = sort_order(sort, SORTS, User.id, cursor) if sort else None
+    query = db.query(*select_columns(COLUMNS, fields, cursor, CURSOR_COLUMNS, optional=OPTIONAL_COLUMNS))
     if username:
         query = query.filter(User.username == username)
 
-    return query.offset(skip).limit(limit).all()
+    if id_list is not None:
+        return by_ids(query, User.id, id_list).all()
+    if order:
+        query = query.order_by(*order)
+    return paginate(query, skip, limit, cursor, CURSOR_COLUMNS).all()
 
 def get_single_user(
     db: Session,
@@ -32,7 +49,8 @@ def get_single_user(
 
     return query.first()
 
-def create_user(db: Session, user: UserCreate):
+def create_user(db: Session, user: UserCreate, hashed_password: str = None):
+    '''hashed_password can be computed beforehand by the caller, outside of the database session'''
 
     username_query = db.query(User).filter(User.username == user.username).first()
     if username_query:
@@ -51,7 +69,7 @@ def create_user(db: Session, user: UserCreate):
     db_user = User(
         username=user.username,
         email=user.email,
-        hashed_password=get_password_hash(user.password),
+        hashed_password=hashed_password or get_password_hash(user.password),
         disabled=False
     )
 
@@ -62,7 +80,8 @@ def create_user(db: Session, user: UserCreate):
     return db_user
 
 
-def update_user(db: Session, user_to_update: UserUpdate, user_id: int):
+def update_user(db: Session, user_to_update: UserUpdate, user_id: int, hashed_password: str = None):
+    '''hashed_password can be computed beforehand by the caller, outside of the database session'''
     query = db.query(User).filter(User.id == user_id)
     query_count = query.count()
 
@@ -97,16 +116,20 @@ def update_user(db: Session, user_to_update: UserUpdate, user_id: int):
         update = query.update({User.disabled: user_to_update.disabled})
 
     if user_to_update.password:
-        update = query.update({User.hashed_password: get_password_hash(user_to_update.password)})
+        update = query.update({User.hashed_password: hashed_password or get_password_hash(user_to_update.password)})
 
     db.commit()
+    principal_cache.invalidate_user(user_id)
     return db.query(User).filter(User.id == user_id).first()
 
 
 def delete_user(db: Session, user_id: int):
+    # the comments of a deleted user are kept, so the comment counts of their episodes and characters don't change,
+    # and users ids are never reused so no new user gets them counted
 
     deletion = db.query(User).filter(User.id == user_id).delete()
     db.commit()
+    principal_cache.invalidate_user(user_id)
     if not deletion:
         return None
 
@@ -0,0 +1,68 @@
+import threading
+import time
+from datetime import datetime
+from decouple import config
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+
+from models.models import DataVersion
+
+# Tables only written by import_data
+REFERENCE_TABLES = ("episodes", "characters", "appearances")
+
+
+def bump_versions(connection, *table_names: str):
+    '''Increments the version of tables, in the transaction of the caller (a session or a connection)'''
+    now = datetime.utcnow()
+    for table_name in table_names:
+        statement = insert(DataVersion).values(table_name=table_name, version=1, updated_at=now)
+        statement = statement.on_conflict_do_update(
+            index_elements=[DataVersion.table_name],
+            set_={"version": DataVersion.version + 1, "updated_at": now},
+        )
+        connection.execute(statement)
+
+
+def get_versions(connection, table_names: tuple):
+    '''Returns the version and last update time of tables, tables never written have version 0'''
+    query = select(DataVersion.table_name, DataVersion.version, DataVersion.updated_at).where(
+        DataVersion.table_name.in_(table_names)
+    )
+    rows = {row.table_name: (row.version, row.updated_at) for row in connection.execute(query)}
+    return {table_name: rows.get(table_name, (0, None)) for table_name in table_names}
+
+
+def reference_version(connection):
+    '''Returns a value that changes every time an import writes the reference tables'''
+    return tuple(version for version, _ in get_versions(connection, REFERENCE_TABLES).values())
+
+
+class VersionCache:
+    '''
+        Versions of tables kept in process for ttl seconds, so conditional requests can be answered without a query.
+        Writes made by this process invalidate it, ttl bounds how long writes of other processes go unnoticed.
+    '''
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, connection, table_names: tuple):
+        '''Returns the version and last update time of tables, from the cache when it is fresh'''
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(table_names)
+        if entry is not None and now - entry[0] < self.ttl:
+            return entry[1]
+        table_versions = get_versions(connection, table_names)
+        with self._lock:
+            self._entries[table_names] = (now, table_versions)
+        return table_versions
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+
+version_cache = VersionCache(config("VERSION_CACHE_SECONDS", default=1, cast=float))
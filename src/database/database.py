@@ -1,20 +1,66 @@
-from sqlalchemy import create_engine
+import logging
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool
 
+from database.settings import EngineSettings
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./sql_app.db"
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, echo = True, connect_args={"check_same_thread": False})
+def create_configured_engine(settings: EngineSettings):
+    '''Returns an engine built from the settings, SQLite pragmas are applied to every new connection'''
+    options = {"echo": settings.echo}
+    if settings.is_sqlite:
+        options["connect_args"] = {"check_same_thread": False}
+    if settings.pool_size is not None:
+        # SQLAlchemy doesn't pool SQLite file connections by default, so the pool is set explicitly
+        options["poolclass"] = QueuePool
+        options["pool_size"] = settings.pool_size
+        if settings.max_overflow is not None:
+            options["max_overflow"] = settings.max_overflow
+
+    engine = create_engine(settings.url, **options)
+
+    if settings.is_sqlite and settings.pragmas:
+        @event.listens_for(engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma, value in settings.pragmas.items():
+                cursor.execute(f"PRAGMA {pragma} = {value}")
+            cursor.close()
+
+    return engine
+
+
+logger = logging.getLogger(__name__)
+
+settings = EngineSettings()
+
+SQLALCHEMY_DATABASE_URL = settings.url
+
+engine = create_configured_engine(settings)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
+def create_tables(bind=engine):
+    '''Creates the missing tables, and the indexes missing from tables that already exist'''
+    Base.metadata.create_all(bind=bind)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=bind, checkfirst=True)
+            except OperationalError as e:
+                # the table was created by an older version and lacks the indexed column
+                logger.warning("Could not create index %s, import the data again to update the table "
+                    "(python3 -m maintenance recount-comments adds the comment counts): %s", index.name, e.orig)
+
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
-
@@ -0,0 +1,81 @@
+from decouple import config
+
+
+# Settings of each engine profile, every one of them can be overridden by an environment variable of the same name
+PROFILES = {
+    # Keeps SQLite defaults, statements are profiled per request by the monitoring package instead of echoed
+    "development": {
+        "DATABASE_ECHO": False,
+        "DATABASE_POOL_SIZE": None,
+        "DATABASE_MAX_OVERFLOW": None,
+        "SQLITE_JOURNAL_MODE": None,
+        "SQLITE_SYNCHRONOUS": None,
+        "SQLITE_CACHE_SIZE": None,
+        "SQLITE_MMAP_SIZE": None,
+        "SQLITE_TEMP_STORE": None,
+        "SQLITE_BUSY_TIMEOUT": None,
+    },
+    # Tuned for many concurrent readers and a single writer:
+    # WAL lets readers go on while the writer commits, NORMAL synchronous is safe with WAL,
+    # and pooled connections keep their page cache and memory map between requests
+    "production": {
+        "DATABASE_ECHO": False,
+        "DATABASE_POOL_SIZE": 10,
+        "DATABASE_MAX_OVERFLOW": 20,
+        "SQLITE_JOURNAL_MODE": "WAL",
+        "SQLITE_SYNCHRONOUS": "NORMAL",
+        "SQLITE_CACHE_SIZE": -64000,  # negative values are in KiB, so 64MB
+        "SQLITE_MMAP_SIZE": 268435456,  # 256MB
+        "SQLITE_TEMP_STORE": "MEMORY",
+        "SQLITE_BUSY_TIMEOUT": 5000,  # milliseconds
+    },
+}
+
+# Connection pragmas and the type of their values
+SQLITE_PRAGMAS = {
+    "journal_mode": ("SQLITE_JOURNAL_MODE", str),
+    "synchronous": ("SQLITE_SYNCHRONOUS", str),
+    "cache_size": ("SQLITE_CACHE_SIZE", int),
+    "mmap_size": ("SQLITE_MMAP_SIZE", int),
+    "temp_store": ("SQLITE_TEMP_STORE", str),
+    "busy_timeout": ("SQLITE_BUSY_TIMEOUT", int),
+}
+
+
+def _setting(profile: dict, name: str, cast=str):
+    '''Returns the value of a setting from the environment, or from the profile when it isn't set'''
+    default = profile[name]
+    if cast is bool:
+        return config(name, default=default, cast=bool)
+    value = config(name, default=None)
+    if value is None or value == "":
+        return default
+    return cast(value)
+
+
+class EngineSettings:
+    '''Engine configuration built from a profile and the environment'''
+
+    def __init__(self, profile_name: str = None, url: str = None):
+        self.profile = profile_name or config("DATABASE_PROFILE", default="development")
+        if self.profile not in PROFILES:
+            raise ValueError(f"Unknown database profile {self.profile}, available profiles are {', '.join(PROFILES)}")
+        profile = PROFILES[self.profile]
+
+        self.url = url or config("DATABASE_URL", default="sqlite:///./sql_app.db")
+        self.echo = _setting(profile, "DATABASE_ECHO", bool)
+        self.pool_size = _setting(profile, "DATABASE_POOL_SIZE", int)
+        self.max_overflow = _setting(profile, "DATABASE_MAX_OVERFLOW", int)
+        self.pragmas = {}
+        for pragma, (name, cast) in SQLITE_PRAGMAS.items():
+            value = _setting(profile, name, cast)
+            if value is None:
+                continue
+            # pragma values can't be bound as parameters, so only accept plain words and numbers
+            if not str(value).lstrip("-").isalnum():
+                raise ValueError(f"Invalid value {value} for {name}")
+            self.pragmas[pragma] = value
+
+    @property
+    def is_sqlite(self):
+        return self.url.startswith("sqlite")
@@ -1,86 +1,380 @@
 from datetime import datetime
+import hashlib
 import json
+import re
+import time
+from sqlalchemy import inspect, select
 from sqlalchemy.exc import OperationalError
 import argparse
 
-from database.database import Base, SessionLocal, engine
-from models.models import Episode, Character, Appearance, Comment, User
-from tests.test_main import get_season_ep_number
+from database.database import create_tables, engine
+from models.models import Episode, Character, Appearance, Comment, User, normalize_name
+from crud.comments import recount_comments
+from crud.statistics import build_statistics
+from crud.versions import REFERENCE_TABLES, bump_versions
 
 
-parser = argparse.ArgumentParser(description="Initialize database and add Episodes & Characters data")
-parser.add_argument("-d", "--drop", action="store_true", help="Drop Comment and User tables")
-parser.add_argument("-k", "--keep", action="store_true",
-                    help="Keep Episode, Character and Appearance tables (deleted by default)")
-args = parser.parse_args()
+EPISODE_COLUMNS = ("id", "title", "title_normalized", "air_date", "episode_number", "season_number", "source_hash")
+CHARACTER_COLUMNS = (
+    "id", "name", "name_normalized", "status", "species", "character_type", "gender", "source_hash"
+)
+APPEARANCE_COLUMNS = ("episode_id", "character_id")
+
+WHITESPACE = re.compile(r"\s*")
 
-if not args.keep:
-    try:
-        Episode.__table__.drop(engine)
-        Character.__table__.drop(engine)
-        Appearance.__table__.drop(engine)
-    except OperationalError:
-        pass
 
-if args.drop:
+def get_season_ep_number(season_ep):
+    '''Returns an int season number and int episode number from string "S##E##"'''
     try:
-        Comment.__table__.drop(engine)
-        User.__table__.drop(engine)
-    except OperationalError:
-        pass
+        split_episode = season_ep.split("E")
+        season_string = split_episode[0]
+        episode_string = split_episode[-1]
+        # method to only keep digits form the string
+        season_int = int(''.join(c for c in season_string if c.isdigit()))
+        episode_int = int(''.join(c for c in episode_string if c.isdigit()))
+    except Exception as e:
+        print(e)
+        return None, None
 
-Base.metadata.create_all(engine)
+    return season_int, episode_int
 
-session = SessionLocal()
 
-# Import episodes
-print("Now importing Episodes")
-episodes = {}
-with open("data/rick_morty-episodes_v1.json") as f:
-    episodes = json.load(f)
+def iter_json_array(f, chunk_size=65536):
+    '''
+        Yields the elements of a JSON array one by one while reading the file chunk by chunk,
+        so only the current chunk and element are held in memory whatever the size of the file
+    '''
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+    state = "start"  # then "first" after "[", "separator" after an element and "element" after ","
 
+    while True:
+        pos = WHITESPACE.match(buffer, pos).end()
+        if pos == len(buffer):
+            if eof:
+                raise ValueError("Unexpected end of file in JSON array")
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
 
-for i, episode_ in enumerate(episodes):
-    try:
-        air_date = datetime.strptime(episode_["air_date"], "%B %d, %Y")
-        season_int, episode_int = get_season_ep_number(episode_["episode"])
-        id_check_query = session.query(Episode).filter(Episode.id == episode_["id"]).count()
-        if id_check_query == 0:
-            row = Episode(
-                id=episode_["id"],
-                title=episode_["name"],
-                air_date=air_date,
-                episode_number=episode_int,
-                season_number=season_int
+        char = buffer[pos]
+        if state == "start":
+            if char != "[":
+                raise ValueError("Expected a JSON array")
+            pos += 1
+            state = "first"
+        elif state in ("first", "separator") and char == "]":
+            return
+        elif state == "separator":
+            if char != ",":
+                raise ValueError(f"Expected ',' or ']' in JSON array, got {char!r}")
+            pos += 1
+            state = "element"
+        else:
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+                # an element touching the end of the buffer may go on in the next chunk
+                complete = end < len(buffer) or eof
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                complete = False
+            if not complete:
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer, pos = buffer[pos:] + chunk, 0
+                continue
+            yield element
+            pos = end
+            state = "separator"
+
+
+def iter_ndjson(f):
+    '''Yields the records of a newline delimited JSON file one by one'''
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+
+def iter_records(path, file_format="auto"):
+    '''Yields the records of a JSON array or NDJSON file, the format is guessed from the extension with "auto"'''
+    if file_format == "auto":
+        file_format = "ndjson" if path.endswith((".ndjson", ".jsonl")) else "json"
+    with open(path) as f:
+        if file_format == "ndjson":
+            yield from iter_ndjson(f)
+        else:
+            yield from iter_json_array(f)
+
+
+def batched(records, batch_size):
+    '''Groups records in lists of batch_size records'''
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Progress:
+    '''Prints the number of rows written and the throughput after each batch'''
+
+    def __init__(self, name):
+        self.name = name
+        self.inserted = 0
+        self.updated = 0
+        self.deleted = 0
+        self.start = time.perf_counter()
+
+    @property
+    def count(self):
+        return self.inserted + self.updated + self.deleted
+
+    def rate(self):
+        return self.count / max(time.perf_counter() - self.start, 1e-9)
+
+    def summary(self):
+        return f"{self.inserted} inserted, {self.updated} updated, {self.deleted} deleted"
+
+    def update(self, inserted, updated=0, deleted=0):
+        self.inserted += inserted
+        self.updated += updated
+        self.deleted += deleted
+        print(f"  {self.name}: {self.summary()} ({self.rate():.0f} rows/s)")
+
+    def done(self):
+        elapsed = time.perf_counter() - self.start
+        print(f"Imported {self.name} in {elapsed:.2f}s: {self.summary()} ({self.rate():.0f} rows/s)")
+
+
+def record_hash(record):
+    '''Returns a hash of the content of a source record, the same whatever the order of its keys'''
+    return hashlib.sha1(json.dumps(record, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+def insert_rows(connection, table, columns, rows):
+    '''Inserts rows given as plain tuples with one executemany, rows with an existing primary key are skipped'''
+    if not rows:
+        return
+    statement = "INSERT OR IGNORE INTO {} ({}) VALUES ({})".format(
+        table.name, ", ".join(columns), ", ".join("?" for _ in columns)
+    )
+    connection.exec_driver_sql(statement, rows)
+
+
+def update_rows(connection, table, columns, rows):
+    '''Updates rows given as plain tuples starting with their id with one executemany'''
+    if not rows:
+        return
+    statement = "UPDATE {} SET {} WHERE id = ?".format(
+        table.name, ", ".join(f"{column} = ?" for column in columns[1:])
+    )
+    connection.exec_driver_sql(statement, [row[1:] + row[:1] for row in rows])
+
+
+def delete_appearances(connection, appearances):
+    if not appearances:
+        return
+    connection.exec_driver_sql(
+        "DELETE FROM appearances WHERE episode_id = ? AND character_id = ?", list(appearances)
+    )
+
+
+def chunks(values, size=500):
+    '''Splits values to stay under the limit of variables in one SQLite statement'''
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def existing_hashes(connection, table, ids):
+    '''Returns the source hash of the rows of a batch already in a table, by id'''
+    hashes = {}
+    for chunk in chunks(ids):
+        query = select(table.c.id, table.c.source_hash).where(table.c.id.in_(chunk))
+        hashes.update(connection.execute(query).all())
+    return hashes
+
+
+def existing_appearances(connection, character_ids):
+    appearances = set()
+    for chunk in chunks(character_ids):
+        query = select(Appearance.episode_id, Appearance.character_id).where(Appearance.character_id.in_(chunk))
+        appearances.update(tuple(row) for row in connection.execute(query))
+    return appearances
+
+
+def episode_row(episode_):
+    air_date = datetime.strptime(episode_["air_date"], "%B %d, %Y").date()
+    season_int, episode_int = get_season_ep_number(episode_["episode"])
+    return (
+        episode_["id"],
+        episode_["name"],
+        normalize_name(episode_["name"]),
+        air_date.isoformat(),
+        episode_int,
+        season_int,
+        record_hash(episode_),
+    )
+
+
+def character_row(character):
+    return (
+        character["id"],
+        character["name"],
+        normalize_name(character["name"]),
+        character["status"].lower(),
+        character["species"],
+        character["type"],
+        character["gender"].lower(),
+        record_hash(character),
+    )
+
+
+def split_batch(connection, table, batch, incremental):
+    '''
+        Returns the records of a batch that are new and the ones that changed since the last import.
+        Existing records are only compared to their stored hash in incremental mode, they are skipped otherwise.
+    '''
+    hashes = existing_hashes(connection, table, [record["id"] for record in batch])
+    new_records = [record for record in batch if record["id"] not in hashes]
+    changed_records = []
+    if incremental:
+        changed_records = [
+            record for record in batch
+            if record["id"] in hashes and hashes[record["id"]] != record_hash(record)
+        ]
+    return new_records, changed_records
+
+
+def import_episodes(episodes, batch_size, incremental=False, bind=engine):
+    '''Imports episodes from any iterable of records, one transaction per batch'''
+    progress = Progress("episodes")
+    for batch in batched(episodes, batch_size):
+        with bind.begin() as connection:
+            new_episodes, changed_episodes = split_batch(connection, Episode.__table__, batch, incremental)
+            insert_rows(connection, Episode.__table__, EPISODE_COLUMNS, [episode_row(e) for e in new_episodes])
+            update_rows(connection, Episode.__table__, EPISODE_COLUMNS, [episode_row(e) for e in changed_episodes])
+        progress.update(len(new_episodes), len(changed_episodes))
+    progress.done()
+    return progress.count
+
+
+def import_characters(characters, batch_size, incremental=False, bind=engine):
+    '''
+        Imports characters and their appearances from any iterable of records, one transaction per batch.
+        The appearances of changed characters are diffed against the ones in the database.
+    '''
+    progress = Progress("characters")
+    appearances_progress = Progress("appearances")
+    for batch in batched(characters, batch_size):
+        with bind.begin() as connection:
+            new_characters, changed_characters = split_batch(connection, Character.__table__, batch, incremental)
+            insert_rows(connection, Character.__table__, CHARACTER_COLUMNS, [character_row(c) for c in new_characters])
+            update_rows(
+                connection, Character.__table__, CHARACTER_COLUMNS, [character_row(c) for c in changed_characters]
             )
-            session.add(row)
-    except OperationalError:
-        pass
-session.commit()
-
-
-# Import characters
-print("Now importing Characters")
-characters = {}
-with open("data/rick_morty-characters_v1.json") as f:
-    characters = json.load(f)
-
-for i, character in enumerate(characters):
-    id_check_query = session.query(Character).filter(Character.id == character["id"]).count()
-    if id_check_query == 0:
-        row = Character(
-            id=character["id"],
-            name=character["name"],
-            status=character["status"].lower(),
-            species=character["species"],
-            character_type=character["type"],
-            gender=character["gender"].lower(),
-        )
-        session.add(row)
-
-        # Add characters appearances in episodes
-        for episode in character["episode"]:
-            appearance = Appearance(episode_id=episode, character_id=row.id)
-            session.add(appearance)
-
-session.commit()
+
+            # Add characters appearances in episodes
+            new_appearances = [
+                (episode, character["id"]) for character in new_characters for episode in character["episode"]
+            ]
+            wanted_appearances = set(
+                (episode, character["id"]) for character in changed_characters for episode in character["episode"]
+            )
+            current_appearances = existing_appearances(connection, [character["id"] for character in changed_characters])
+            new_appearances.extend(wanted_appearances - current_appearances)
+            removed_appearances = current_appearances - wanted_appearances
+            insert_rows(connection, Appearance.__table__, APPEARANCE_COLUMNS, new_appearances)
+            delete_appearances(connection, removed_appearances)
+
+        progress.update(len(new_characters), len(changed_characters))
+        appearances_progress.update(len(new_appearances), deleted=len(removed_appearances))
+    progress.done()
+    appearances_progress.done()
+    return progress.count + appearances_progress.count
+
+
+def check_incremental_schema(bind=engine):
+    '''
+        Stops the import if the tables were created before a column it writes or reads existed,
+        the source hashes, the normalized names or the comment counts recounted at the end
+    '''
+    required_columns = {
+        Episode.__table__: EPISODE_COLUMNS + ("comment_count",),
+        Character.__table__: CHARACTER_COLUMNS + ("comment_count",),
+        Appearance.__table__: APPEARANCE_COLUMNS,
+    }
+    for table, required in required_columns.items():
+        columns = [column["name"] for column in inspect(bind).get_columns(table.name)]
+        missing = [name for name in required if name not in columns]
+        if columns and missing:
+            raise SystemExit(f"Table {table.name} has no {', '.join(missing)} column, run a full import first")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Initialize database and add Episodes & Characters data")
+    parser.add_argument("-d", "--drop", action="store_true", help="Drop Comment and User tables")
+    parser.add_argument("-k", "--keep", action="store_true",
+                        help="Keep Episode, Character and Appearance tables (deleted by default)")
+    parser.add_argument("-i", "--incremental", action="store_true",
+                        help="Keep the tables and only insert new records and update the ones that changed")
+    parser.add_argument("-b", "--batch-size", type=int, default=5000, help="Number of records written per transaction")
+    parser.add_argument("--episodes", default="data/rick_morty-episodes_v1.json",
+                        help="Episodes file, a JSON array or NDJSON (.ndjson or .jsonl)")
+    parser.add_argument("--characters", default="data/rick_morty-characters_v1.json",
+                        help="Characters file, a JSON array or NDJSON (.ndjson or .jsonl)")
+    parser.add_argument("--format", choices=("auto", "json", "ndjson"), default="auto",
+                        help="Format of the files, guessed from their extension by default")
+    args = parser.parse_args()
+
+    if args.incremental:
+        check_incremental_schema()
+
+    if not args.keep and not args.incremental:
+        try:
+            Episode.__table__.drop(engine)
+            Character.__table__.drop(engine)
+            Appearance.__table__.drop(engine)
+        except OperationalError:
+            pass
+
+    if args.drop:
+        try:
+            Comment.__table__.drop(engine)
+            User.__table__.drop(engine)
+        except OperationalError:
+            pass
+
+    create_tables()
+
+    start = time.perf_counter()
+
+    # Files are parsed record by record and written batch by batch, so memory doesn't grow with their size
+    print("Now importing Episodes")
+    total = import_episodes(iter_records(args.episodes, args.format), args.batch_size, args.incremental)
+
+    print("Now importing Characters")
+    total += import_characters(iter_records(args.characters, args.format), args.batch_size, args.incremental)
+
+    with engine.begin() as connection:
+        # recreated episodes and characters start without comments, kept comments may point to them
+        recount_comments(connection, ("episodes", "characters"))
+        print("Now building statistics")
+        build_statistics(connection)
+        # servers holding the reference data in memory reload it when they see the new version
+        bump_versions(connection, *REFERENCE_TABLES, "statistics")
+        if args.drop:
+            bump_versions(connection, "comments", "users")
+
+    elapsed = time.perf_counter() - start
+    print(f"Wrote {total} rows in total in {elapsed:.2f}s ({total / max(elapsed, 1e-9):.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,26 @@
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Request
 from http import HTTPStatus
 from typing import List
+from pydantic import conlist
 from sqlalchemy.orm import Session
-from datetime import date, timedelta
+from datetime import date, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+import hashlib
 import uvicorn
 from decouple import config
 from fastapi.security import OAuth2PasswordRequestForm
-import csv
-import io
-from fastapi.responses import StreamingResponse, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, StreamingResponse, Response, PlainTextResponse
 
 from auth.auth_handler import authenticate_user, create_access_token, get_current_active_user
-from database.database import Base, engine, get_db
-from crud import episodes, characters, comments, users
+from auth.passwords import get_password_hash_async
+from database.database import create_tables, get_db, SessionLocal
+from crud import episodes, characters, comments, users, pagination, reference_data, relations, statistics, versions
+from crud.fields import field_names, parse_include
 from schemas import schemas
+from monitoring import metrics, queries
+from monitoring.middleware import RequestProfilingMiddleware
+from monitoring.timing import phase
 from models.models import Comment, StatusEnum, GenderEnum
 
 
@@ -21,7 +28,8 @@ SECRET_KEY = config("secret")
 ALGORITHM = config("algorithm")
 ACCESS_TOKEN_EXPIRE_MINUTES = config("ACCESS_TOKEN_EXPIRE_MINUTES", default = 30)
 
-Base.metadata.create_all(bind=engine)
+create_tables()
+queries.install()
 
 description = """
     This is the technical test I made for Jellysmack
@@ -38,9 +46,102 @@ app = FastAPI(
 )
 
 
+app.add_middleware(RequestProfilingMiddleware)
+
+
+@app.on_event("startup")
+def load_reference_data():
+    '''Loads episodes and characters in memory before the first request when REFERENCE_DATA_IN_MEMORY is set'''
+    db = SessionLocal()
+    try:
+        reference_data.current(db)
+    finally:
+        db.close()
+
+
+# Routes that use the database are declared with "def" and not "async def":
+# FastAPI runs them in its threadpool, so the synchronous SQLAlchemy calls don't block the event loop.
+# Routes that hash passwords stay "async def": bcrypt runs in the bounded password hashing pool
+# and their database calls are sent to the threadpool with run_in_threadpool.
+# Every other "async def" route never waits on the database or on the CPU.
+
+# List routes select plain rows with the columns of their schema and encode them with orjson,
+# skipping the validation and copy of every row by the response_model, which only documents them.
+
+
+def set_next_cursor(response: Response, rows: list, limit: int, cursor: str, cursor_columns: tuple):
+    '''Sets the X-Next-Cursor header when a list route is paged with a cursor and has a next page'''
+    if cursor is None:
+        return
+    next_cursor = pagination.next_cursor(rows, limit, cursor_columns)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+
+
+def rows_response(
+    response: Response, rows: list, columns: tuple = (), fields: str = None, included: dict = None, optional: tuple = ()
+):
+    '''
+        Returns rows selected as plain tuples encoded as a JSON list of objects, with the headers set on response.
+        Only the fields asked for are encoded, rows may hold more columns, like the cursor ones.
+        included maps the name of each embedded relation to the related objects by row id.
+    '''
+    with phase("serialization"):
+        if fields:
+            names = field_names(columns, fields, optional)
+            content = [{name: getattr(row, name) for name in names} for row in rows]
+        else:
+            content = [row._asdict() for row in rows]
+        for name, related in (included or {}).items():
+            for item, row in zip(content, rows):
+                item[name] = related.get(row.id, [])
+        return ORJSONResponse(content, headers=dict(response.headers))
+
+
+def read_tables(table_names: tuple, fields: str = None, sort: str = None):
+    '''Returns the tables a list reads, comment counts are written along with the comments'''
+    if sort or (fields and "comment_count" in fields):
+        return table_names + ("comments",)
+    return table_names
+
+
+def not_modified(request: Request, response: Response, db: Session, table_names: tuple):
+    '''
+        Sets the ETag and Last-Modified headers of a list route from the versions of the tables it reads,
+        and returns a 304 response when the client already has this version of the page, before any query is made.
+    '''
+    table_versions = versions.version_cache.get(db, table_names)
+    # the page depends on the url as much as on the data
+    validator = repr((request.url.path, str(request.url.query), sorted(table_versions.items())))
+    etag = 'W/"{}"'.format(hashlib.sha1(validator.encode()).hexdigest())
+    headers = {"ETag": etag}
+    updates = [updated_at for _, updated_at in table_versions.values() if updated_at is not None]
+    last_modified = max(updates).replace(tzinfo=timezone.utc, microsecond=0) if updates else None
+    if last_modified:
+        headers["Last-Modified"] = format_datetime(last_modified, usegmt=True)
+    response.headers.update(headers)
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if etag in (tag.strip() for tag in if_none_match.split(",")) or if_none_match.strip() == "*":
+            return Response(status_code=HTTPStatus.NOT_MODIFIED.value, headers=headers)
+        return None
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified:
+        try:
+            if last_modified <= parsedate_to_datetime(if_modified_since):
+                return Response(status_code=HTTPStatus.NOT_MODIFIED.value, headers=headers)
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
 # Episodes ------------------------------------------------------------
 @app.get("/api/v1/episodes", response_model=List[schemas.Episode])
-async def read_episodes(
+def read_episodes(
+    request: Request,
+    response: Response,
     db: Session = Depends(get_db),
     skip: int = 0,
     limit: int = 25,
@@ -48,60 +149,134 @@ async def read_episodes(
     after_air_date: date = None,
     episode_number: int = None,
     season_number: str = None,
-    character_name: str = None
+    character_name: str = None,
+    cursor: str = None,
+    fields: str = None,
+    ids: str = None,
+    include: str = None,
+    sort: str = None
 ):
-    return episodes.get_episodes(
+    '''
+        Episodes are paged with skip and limit by default.
+        Send an empty "cursor" to page by air date instead, the cursor of the next page
+        is then returned in the X-Next-Cursor header.
+        Responses carry an ETag, send it back in If-None-Match to get a 304 while the episodes didn't change.
+        "fields" is a comma separated list of the fields to return, all of them by default.
+        "ids" is a comma separated list of ids to fetch at once, returned in the same order without paging.
+        "include=characters" embeds the characters of every episode, loaded for the whole page at once.
+        "sort=-comment_count" lists the most commented episodes first, "comment_count" is also available in fields.
+    '''
+    cached = not_modified(request, response, db, read_tables(versions.REFERENCE_TABLES, fields, sort))
+    if cached:
+        return cached
+    rows = episodes.get_episodes(
         db, skip, limit, before_air_date, after_air_date,
-        episode_number, season_number, character_name
+        episode_number, season_number, character_name, cursor, fields, ids, include, sort
     )
+    included = {}
+    if "characters" in parse_include(include, episodes.RELATIONS):
+        included["characters"] = relations.get_episodes_characters(db, [row.id for row in rows])
+    set_next_cursor(response, rows, limit, cursor, episodes.CURSOR_COLUMNS)
+    return rows_response(response, rows, episodes.COLUMNS, fields, included, episodes.OPTIONAL_COLUMNS)
 
 
 
 # Characters ------------------------------------------------------------
 @app.get("/api/v1/characters", response_model=List[schemas.Character])
-async def read_characters(db: Session = Depends(get_db),
+def read_characters(request: Request, response: Response,
+    db: Session = Depends(get_db),
     skip: int = 0,
     limit: int = 25,
     status: StatusEnum = None,
     species: str = None,
     character_type: str = None,
     gender: GenderEnum = None,
-    episode_name: str = None
+    episode_name: str = None,
+    cursor: str = None,
+    fields: str = None,
+    ids: str = None,
+    include: str = None,
+    sort: str = None
 ):
-
-    return characters.get_characters(
-        db, skip, limit, status, species, character_type, gender, episode_name
+    '''
+        Characters are paged with skip and limit by default.
+        Send an empty "cursor" to page by id instead, the cursor of the next page
+        is then returned in the X-Next-Cursor header.
+        Responses carry an ETag, send it back in If-None-Match to get a 304 while the characters didn't change.
+        "fields" is a comma separated list of the fields to return, all of them by default.
+        "ids" is a comma separated list of ids to fetch at once, returned in the same order without paging.
+        "include=episodes" embeds the episodes of every character, loaded for the whole page at once.
+        "sort=-comment_count" lists the most commented characters first, "comment_count" is also available in fields.
+    '''
+    cached = not_modified(request, response, db, read_tables(versions.REFERENCE_TABLES, fields, sort))
+    if cached:
+        return cached
+    rows = characters.get_characters(
+        db, skip, limit, status, species, character_type, gender, episode_name, cursor, fields, ids, include, sort
     )
+    included = {}
+    if "episodes" in parse_include(include, characters.RELATIONS):
+        included["episodes"] = relations.get_characters_episodes(db, [row.id for row in rows])
+    set_next_cursor(response, rows, limit, cursor, characters.CURSOR_COLUMNS)
+    return rows_response(response, rows, characters.COLUMNS, fields, included, characters.OPTIONAL_COLUMNS)
 
 
 
 # Comments ------------------------------------------------------------
 @app.get("/api/v1/comments", response_model=List[schemas.Comment])
-async def read_comments(db: Session = Depends(get_db),
+def read_comments(request: Request, response: Response,
+    db: Session = Depends(get_db),
     skip: int = 0,
     limit: int = 25,
     episode_id: int = None,
     character_id: int = None,
-    user_id: int = None
+    user_id: int = None,
+    cursor: str = None,
+    q: str = None,
+    fields: str = None,
+    ids: str = None
 ):
-
-    return comments.get_comments(
-         db, skip, limit, episode_id, character_id, user_id
+    '''
+        Comments are paged with skip and limit by default.
+        Send an empty "cursor" to page by id instead, the cursor of the next page
+        is then returned in the X-Next-Cursor header.
+        "q" searches the content of the comments for all of its words, best matches first.
+        Only the newest SEARCH_CANDIDATES (1000) matches are ranked, or skip + limit when larger,
+        so an older comment matching a common word better than them is never returned.
+        Responses carry an ETag, send it back in If-None-Match to get a 304 while the comments didn't change.
+        "fields" is a comma separated list of the fields to return, all of them by default.
+        "ids" is a comma separated list of ids to fetch at once, returned in the same order without paging.
+    '''
+    cached = not_modified(request, response, db, ("comments",))
+    if cached:
+        return cached
+    rows = comments.get_comments(
+         db, skip, limit, episode_id, character_id, user_id, cursor, q, fields, ids
     )
+    set_next_cursor(response, rows, limit, cursor, comments.CURSOR_COLUMNS)
+    return rows_response(response, rows, comments.COLUMNS, fields)
 
 
 @app.get("/api/v1/users/me/comments", response_model=List[schemas.Comment])
-async def read_own_comments(
+def read_own_comments(
+    response: Response,
     db: Session = Depends(get_db),
     current_user: schemas.User = Depends(get_current_active_user),
     skip: int = 0,
-    limit : int = 25
+    limit : int = 25,
+    cursor: str = None,
+    fields: str = None,
+    ids: str = None
 ):
-    return comments.get_comments(db, skip, limit, user_id = current_user.id)
+    rows = comments.get_comments(
+        db, skip, limit, user_id = current_user.id, cursor = cursor, fields = fields, ids = ids
+    )
+    set_next_cursor(response, rows, limit, cursor, comments.CURSOR_COLUMNS)
+    return rows_response(response, rows, comments.COLUMNS, fields)
 
 
 @app.post("/api/v1/comments", response_model=schemas.Comment, status_code=201)
-async def create_comments(
+def create_comments(
     comment: schemas.CommentCreate,
     db: Session = Depends(get_db),
     current_user: schemas.User = Depends(get_current_active_user)
@@ -113,14 +288,36 @@ async def create_comments(
     if not comment.episode_id and not comment.character_id:
         raise HTTPException(
             status_code=400,
-            detail="Episode ID or Character ID is required to create a comment",
+            detail=comments.MISSING_TARGET,
         )
 
     return comments.create_comment(db, comment, current_user)
 
 
+@app.post("/api/v1/comments/batch", response_model=schemas.CommentBatchResult, status_code=201)
+def create_comments_batch(
+    response: Response,
+    # the length is checked before the items, a batch too long is rejected without validating them
+    comments_to_create: conlist(schemas.CommentCreate, max_items=comments.MAX_COMMENT_BATCH),
+    db: Session = Depends(get_db),
+    current_user: schemas.User = Depends(get_current_active_user)
+):
+    '''
+        Creates up to MAX_COMMENT_BATCH comments at once, with the same fields as a single comment.
+        A longer list, or a comment that doesn't match the schema, fails the whole request with a 422
+        whose detail locates the error, ["body", index, field], and nothing is created.
+        The other comments are checked first: the ones without an episode or character, or with one that doesn't exist,
+        are returned in "errors" with their index and a detail, the others are created in one transaction
+        and their ids returned in "created" with their index. The status is 400 when no comment was created.
+    '''
+    result = comments.create_comments(db, comments_to_create, current_user)
+    if not result["created"]:
+        response.status_code = 400
+    return result
+
+
 @app.put("/api/v1/comments/{id}", response_model=schemas.Comment)
-async def update_comment(
+def update_comment(
     id: int, comment: schemas.CommentUpdate, db: Session = Depends(get_db)
 ):
     '''
@@ -136,7 +333,7 @@ async def update_comment(
 
 
 @app.delete("/api/v1/comments/{id}", status_code=204)
-async def delete_comment(id: int, db: Session = Depends(get_db)):
+def delete_comment(id: int, db: Session = Depends(get_db)):
     if not comments.delete_comment(db, id):
         raise HTTPException(
             status_code=404,
@@ -145,30 +342,20 @@ async def delete_comment(id: int, db: Session = Depends(get_db)):
     return Response(status_code=HTTPStatus.NO_CONTENT.value)
 
 @app.get("/api/v1/comments/export_csv")
-async def export_comments(db: Session = Depends(get_db)):
+def export_comments(db: Session = Depends(get_db)):
 
     '''Export all comments as csv file'''
 
-    all_comments = db.query(Comment).all()
-    if len(all_comments) == 0:
+    # only check that there is at least one row, the export itself is streamed chunk by chunk
+    if db.query(Comment.id).first() is None:
         raise HTTPException(
             status_code=404,
             detail="No Comments to export",
         )
-    all_comments_dicts = []
-    # convert row objects to dicts and remove instance state element
-    for c in all_comments:
-        row_dict = c.__dict__
-        row_dict.pop("_sa_instance_state")
-        all_comments_dicts.append(row_dict)
-
-    keys = all_comments_dicts[0].keys()
-    stream = io.StringIO()
-    dict_writer = csv.DictWriter(stream, keys)
-    dict_writer.writeheader()
-    dict_writer.writerows(all_comments_dicts)
-
-    response = StreamingResponse(iter([stream.getvalue()]),
+
+    # one keyset query per chunk of rows, not an N+1
+    queries.mark_chunked()
+    response = StreamingResponse(comments.export_comments_csv(db),
                         media_type="text/csv"
     )
     response.headers["Content-Disposition"] = "attachment; filename=comments_export.csv"
@@ -182,7 +369,7 @@ async def login_for_access_token(db: Session = Depends(get_db), form_data: OAuth
 
     '''Returns JWT access_token when user inputs valid username and password for existant and active user'''
 
-    user = authenticate_user(db, form_data.username, form_data.password)
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=401,
@@ -199,13 +386,24 @@ async def login_for_access_token(db: Session = Depends(get_db), form_data: OAuth
 
 # Users -------------------------------------------------------------
 @app.get("/api/v1/users", response_model=List[schemas.User])
-async def read_users(
+def read_users(
+    response: Response,
     skip: int = 0,
     limit: int = 25,
     username: str = None,
+    cursor: str = None,
+    fields: str = None,
+    ids: str = None,
+    sort: str = None,
     db: Session = Depends(get_db)
 ):
-    return users.get_user(db, skip, limit, username)
+    '''
+        "sort=-comment_count" lists the users who wrote the most comments first,
+        "comment_count" is also available in fields.
+    '''
+    rows = users.get_user(db, skip, limit, username, cursor, fields, ids, sort)
+    set_next_cursor(response, rows, limit, cursor, users.CURSOR_COLUMNS)
+    return rows_response(response, rows, users.COLUMNS, fields, optional=users.OPTIONAL_COLUMNS)
 
 
 @app.get("/api/v1/users/me", response_model=schemas.User)
@@ -219,7 +417,8 @@ async def create_user(
     user: schemas.UserCreate,
     db: Session = Depends(get_db)
 ):
-    return users.create_user(db, user)
+    hashed_password = await get_password_hash_async(user.password)
+    return await run_in_threadpool(users.create_user, db, user, hashed_password)
 
 
 @app.put("/api/v1/users/me", response_model=schemas.User)
@@ -228,13 +427,16 @@ async def update_user_self(
     current_user: schemas.User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
-    updated_user = users.update_user(db, user_to_update, current_user.id)
+    hashed_password = None
+    if user_to_update.password:
+        hashed_password = await get_password_hash_async(user_to_update.password)
+    updated_user = await run_in_threadpool(users.update_user, db, user_to_update, current_user.id, hashed_password)
 
     return updated_user
 
 
 @app.delete("/api/v1/users/me", status_code=204)
-async def delete_user_self(
+def delete_user_self(
     current_user: schemas.User = Depends(get_current_active_user),
     db: Session = Depends(get_db)):
     if not users.delete_user(db, current_user.id):
@@ -249,13 +451,16 @@ async def update_user(
     user_to_update: schemas.UserUpdate,
     db: Session = Depends(get_db)
 ): 
-    updated_user = users.update_user(db, user_to_update, user_to_update.id)
+    hashed_password = None
+    if user_to_update.password:
+        hashed_password = await get_password_hash_async(user_to_update.password)
+    updated_user = await run_in_threadpool(users.update_user, db, user_to_update, user_to_update.id, hashed_password)
 
     return updated_user
 
 
 @app.delete("/api/v1/users", status_code=204)
-async def delete_user(
+def delete_user(
     id: int,
     db: Session = Depends(get_db)):
     if not users.delete_user(db, id):
@@ -266,6 +471,73 @@ async def delete_user(
     return Response(status_code=HTTPStatus.NO_CONTENT.value)
 
 
+# Statistics -------------------------------------------------------------
+# Statistics are computed by the import, these routes only read rows by primary key.
+@app.get("/api/v1/stats/episodes", response_model=List[schemas.EpisodeStatistics])
+def read_episode_statistics(
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_db),
+    skip: int = 0,
+    limit: int = 25,
+    ids: str = None
+):
+    '''Number of characters of every episode, "ids" fetches the episodes of a comma separated list'''
+    cached = not_modified(request, response, db, ("statistics",))
+    if cached:
+        return cached
+    return rows_response(response, statistics.get_episode_statistics(db, skip, limit, ids))
+
+
+@app.get("/api/v1/stats/seasons", response_model=List[schemas.SeasonStatistics])
+def read_season_statistics(request: Request, response: Response, db: Session = Depends(get_db)):
+    '''Number of episodes of every season'''
+    cached = not_modified(request, response, db, ("statistics",))
+    if cached:
+        return cached
+    return rows_response(response, statistics.get_season_statistics(db))
+
+
+@app.get("/api/v1/stats/characters", response_model=List[schemas.CharacterStatistics])
+def read_character_statistics(
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_db),
+    skip: int = 0,
+    limit: int = 25,
+    ids: str = None
+):
+    '''Number of episodes every character appears in, "ids" fetches the characters of a comma separated list'''
+    cached = not_modified(request, response, db, ("statistics",))
+    if cached:
+        return cached
+    return rows_response(response, statistics.get_character_statistics(db, skip, limit, ids))
+
+
+@app.get("/api/v1/stats/characters/{field}", response_model=List[schemas.CharacterDistribution])
+def read_character_distribution(field: str, request: Request, response: Response, db: Session = Depends(get_db)):
+    '''Number of characters for every value of "status", "gender" or "species"'''
+    cached = not_modified(request, response, db, ("statistics",))
+    if cached:
+        return cached
+    return rows_response(response, statistics.get_character_distribution(db, field))
+
+
+# Monitoring -------------------------------------------------------------
+@app.get("/api/v1/monitoring/queries")
+async def read_query_stats():
+    '''Number of queries and database time of every route since the start of the process, the busiest first'''
+    return queries.route_stats.snapshot()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def read_metrics():
+    '''Latency histogram, p50, p95 and p99 and database work of every route, in the Prometheus text format'''
+    return PlainTextResponse(
+        metrics.render(metrics.route_latencies, queries.route_stats), media_type=metrics.CONTENT_TYPE
+    )
+
+
 # Home -------------------------------------------------------------
 @app.get("/")
 async def home():
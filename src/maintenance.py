@@ -0,0 +1,62 @@
+import argparse
+from sqlalchemy import inspect, text
+
+from database.database import create_tables, engine
+from crud.comments import COUNTERS, recount_comments
+from crud.statistics import build_statistics
+from crud.versions import bump_versions
+
+
+def rebuild_search_index():
+    '''Rebuilds the full text index of the comments from the comments table'''
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO comments_fts(comments_fts) VALUES ('rebuild')"))
+    print("Rebuilt the comments search index")
+
+
+def recount_comments_command():
+    '''Recomputes the comment counts of the episodes, characters and users, adding the columns to older databases'''
+    added = False
+    for table_name in COUNTERS:
+        columns = [column["name"] for column in inspect(engine).get_columns(table_name)]
+        if "comment_count" not in columns:
+            with engine.begin() as connection:
+                connection.execute(text(
+                    f"ALTER TABLE {table_name} ADD COLUMN comment_count INTEGER NOT NULL DEFAULT 0"
+                ))
+            added = True
+    if added:
+        # indexes on the new columns
+        create_tables()
+    with engine.begin() as connection:
+        recount_comments(connection)
+        bump_versions(connection, "comments")
+    print("Recounted the comments of every episode, character and user")
+
+
+def build_statistics_command():
+    '''Rebuilds the statistics tables without importing the data again'''
+    with engine.begin() as connection:
+        build_statistics(connection)
+        bump_versions(connection, "statistics")
+    print("Rebuilt the statistics tables")
+
+
+COMMANDS = {
+    "rebuild-search-index": rebuild_search_index,
+    "recount-comments": recount_comments_command,
+    "build-statistics": build_statistics_command,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Database maintenance commands")
+    parser.add_argument("command", choices=COMMANDS)
+    args = parser.parse_args()
+
+    create_tables()
+    COMMANDS[args.command]()
+
+
+if __name__ == "__main__":
+    main()
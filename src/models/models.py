@@ -1,17 +1,30 @@
 import enum
 from sqlalchemy.sql.sqltypes import Boolean
-from sqlalchemy import Column, Enum, Date, Integer, String, ForeignKey, CheckConstraint
+from sqlalchemy import Column, Enum, Date, DateTime, Integer, String, ForeignKey, CheckConstraint, DDL, Index, event, table, column
 from sqlalchemy.orm import relationship
 
 from database.database import Base
 
 
+def normalize_name(name):
+    '''Returns the form of a title or name used for case insensitive lookups'''
+    return name.casefold() if name is not None else None
+
+
+def normalized_default(column_name):
+    '''Column default filling a normalized shadow column from the inserted value of column_name'''
+    def default(context):
+        return normalize_name(context.get_current_parameters().get(column_name))
+    return default
+
+
 class Appearance(Base):
     '''Association Class for the many-to-many relationship between episodes and characters'''
     __tablename__ = "appearances"
 
     episode_id = Column(ForeignKey("episodes.id"), primary_key=True)
-    character_id = Column(ForeignKey("characters.id"), primary_key=True)
+    # the primary key starts with episode_id, lookups by character need their own index
+    character_id = Column(ForeignKey("characters.id"), primary_key=True, index=True)
     character = relationship("Character", back_populates="episode")
     episode = relationship("Episode", back_populates="character")
 
@@ -19,12 +32,22 @@ class Appearance(Base):
 class Episode(Base):
 
     __tablename__ = "episodes"
+    __table_args__ = (
+            # also serves the filters on season_number alone
+            Index("ix_episodes_season_number_episode_number", "season_number", "episode_number"),
+            )
 
     id = Column(Integer, index=True, primary_key=True)
     title = Column(String, index=True)
-    air_date = Column(Date)
-    episode_number = Column(Integer, default=0)
+    # case insensitive lookups compare this indexed column, SQLite can't use an index for lower(title)
+    title_normalized = Column(String, index=True, default=normalized_default("title"))
+    air_date = Column(Date, index=True)
+    episode_number = Column(Integer, default=0, index=True)
     season_number = Column(Integer, default=0)
+    # hash of the source record, compared by incremental imports to only update the rows that changed
+    source_hash = Column(String(40))
+    # number of comments on the episode, kept up to date by the comment crud functions
+    comment_count = Column(Integer, nullable=False, default=0, server_default="0", index=True)
 
     character = relationship(Appearance, back_populates="episode")
 
@@ -48,10 +71,14 @@ class Character(Base):
 
     id = Column(Integer, index=True, primary_key=True)
     name = Column(String(255), index=True)
-    status = Column(Enum(StatusEnum))
-    species = Column(String, default="")
-    character_type = Column(String)
-    gender = Column(Enum(GenderEnum))
+    name_normalized = Column(String(255), index=True, default=normalized_default("name"))
+    status = Column(Enum(StatusEnum), index=True)
+    species = Column(String, default="", index=True)
+    character_type = Column(String, index=True)
+    gender = Column(Enum(GenderEnum), index=True)
+    source_hash = Column(String(40))
+    # number of comments on the character, kept up to date by the comment crud functions
+    comment_count = Column(Integer, nullable=False, default=0, server_default="0", index=True)
     episode = relationship(Appearance, back_populates="character")
 
 
@@ -60,21 +87,85 @@ class Comment(Base):
     __tablename__ = "comments"
     __table_args__ = (
             CheckConstraint('NOT(episode_id IS NULL AND character_id IS NULL)'),
+            # also serves the filters on episode_id alone
+            Index("ix_comments_episode_id_character_id", "episode_id", "character_id"),
             )
-        
+
     id = Column(Integer, index=True, primary_key=True)
     content = Column(String)
     episode_id = Column(ForeignKey("episodes.id"), nullable=True)
-    character_id = Column(ForeignKey("characters.id"), nullable=True)
-    user_id = Column(ForeignKey("users.id"))
+    character_id = Column(ForeignKey("characters.id"), nullable=True, index=True)
+    user_id = Column(ForeignKey("users.id"), index=True)
+
+
+# Full text index of the comments content. It's an external content FTS5 table: it doesn't store the content again
+# and is kept in sync with the comments table by the crud functions that write comments.
+comments_fts = table("comments_fts", column("rowid"), column("content"), column("rank"))
+
+# Created on every create_all, so databases where the comments table already exists get it too.
+# Comments written before it existed are indexed with "python3 -m maintenance rebuild-search-index".
+event.listen(Base.metadata, "after_create", DDL(
+    "CREATE VIRTUAL TABLE IF NOT EXISTS comments_fts USING fts5(content, content='comments', content_rowid='id')"
+).execute_if(dialect="sqlite"))
+event.listen(Comment.__table__, "after_drop", DDL("DROP TABLE IF EXISTS comments_fts").execute_if(dialect="sqlite"))
 
 
 class User(Base):
 
     __tablename__ = 'users'
+    # the comments of deleted users are kept, their ids are never given to new users who would inherit them
+    __table_args__ = {"sqlite_autoincrement": True}
 
     id = Column(Integer, index=True, primary_key=True)
-    username = Column(String)
-    email = Column(String)
+    username = Column(String, index=True)
+    email = Column(String, index=True)
     hashed_password = Column(String)
     disabled = Column(Boolean, default = False)
+    # number of comments written by the user, kept up to date by the comment crud functions
+    comment_count = Column(Integer, nullable=False, default=0, server_default="0", index=True)
+
+
+class DataVersion(Base):
+    '''Version of the content of a table, bumped by the writes to the table so caches can tell when it changed'''
+
+    __tablename__ = "data_versions"
+
+    table_name = Column(String, primary_key=True)
+    version = Column(Integer, default=0, nullable=False)
+    updated_at = Column(DateTime)
+
+
+# Statistics tables, rebuilt from episodes, characters and appearances at the end of every import
+# so the statistics routes read rows by primary key instead of aggregating the appearances.
+class EpisodeStatistics(Base):
+
+    __tablename__ = "episode_statistics"
+
+    episode_id = Column(Integer, primary_key=True)
+    character_count = Column(Integer, nullable=False)
+
+
+class SeasonStatistics(Base):
+
+    __tablename__ = "season_statistics"
+
+    season_number = Column(Integer, primary_key=True)
+    episode_count = Column(Integer, nullable=False)
+
+
+class CharacterStatistics(Base):
+
+    __tablename__ = "character_statistics"
+
+    character_id = Column(Integer, primary_key=True)
+    episode_count = Column(Integer, nullable=False)
+
+
+class CharacterDistribution(Base):
+    '''Number of characters for every value of the status, gender and species columns'''
+
+    __tablename__ = "character_distributions"
+
+    field = Column(String, primary_key=True)
+    value = Column(String, primary_key=True)
+    character_count = Column(Integer, nullable=False)
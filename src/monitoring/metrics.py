@@ -0,0 +1,134 @@
+import math
+import threading
+from bisect import bisect_left
+
+from monitoring.queries import RouteStats
+
+# Upper bounds of the request duration buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+class LatencyHistogram:
+    '''Request durations counted in fixed buckets: recording one is a bisect and two additions'''
+
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        # the last count is the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def copy(self):
+        histogram = LatencyHistogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.count = self.count
+        histogram.sum = self.sum
+        return histogram
+
+    def quantile(self, q: float):
+        '''Estimates a quantile by interpolating inside its bucket, like histogram_quantile in Prometheus'''
+        if not self.count:
+            return math.nan
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts[:-1]):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / count
+            cumulative += count
+        # the quantile is in the +Inf bucket
+        return self.buckets[-1]
+
+
+class RouteLatencies:
+    '''Histogram of the request durations of every route since the start of the process'''
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, route: str, seconds: float):
+        with self._lock:
+            histogram = self._histograms.get(route)
+            if histogram is None:
+                histogram = self._histograms[route] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {route: histogram.copy() for route, histogram in self._histograms.items()}
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+route_latencies = RouteLatencies()
+
+
+def escape(value: str):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def labels(route: str, **extra):
+    '''Returns the labels of a route named like "GET /api/v1/episodes", with extra ones'''
+    method, _, path = route.partition(" ")
+    pairs = dict(method=method, route=path, **extra)
+    return "{" + ",".join(f'{name}="{escape(str(value))}"' for name, value in pairs.items()) + "}"
+
+
+def number(value: float):
+    if math.isnan(value):
+        return "NaN"
+    return repr(float(value))
+
+
+def render(latencies: RouteLatencies, stats: RouteStats):
+    '''
+        Returns the metrics in the Prometheus text format: the duration histogram of every route,
+        its p50, p95 and p99 estimated from the buckets and the database work of every route.
+        Everything is computed here, when the metrics are scraped, and not while requests are handled.
+    '''
+    histograms = sorted(latencies.snapshot().items())
+    lines = [
+        "# HELP http_request_duration_seconds Time to handle the requests, until their last body chunk",
+        "# TYPE http_request_duration_seconds histogram",
+    ]
+    for route, histogram in histograms:
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append(f"http_request_duration_seconds_bucket{labels(route, le=number(bound))} {cumulative}")
+        lines.append(f'http_request_duration_seconds_bucket{labels(route, le="+Inf")} {histogram.count}')
+        lines.append(f"http_request_duration_seconds_sum{labels(route)} {number(histogram.sum)}")
+        lines.append(f"http_request_duration_seconds_count{labels(route)} {histogram.count}")
+
+    lines += [
+        "# HELP http_request_duration_quantile_seconds Quantiles of the request durations, estimated from the buckets",
+        "# TYPE http_request_duration_quantile_seconds gauge",
+    ]
+    for route, histogram in histograms:
+        for q in QUANTILES:
+            value = number(histogram.quantile(q))
+            lines.append(f"http_request_duration_quantile_seconds{labels(route, quantile=q)} {value}")
+
+    routes = sorted(stats.snapshot(), key=lambda route: route["route"])
+    lines += [
+        "# HELP db_queries_total Queries run by the requests",
+        "# TYPE db_queries_total counter",
+    ]
+    lines += [f"db_queries_total{labels(route['route'])} {route['queries']}" for route in routes]
+    lines += [
+        "# HELP db_duration_seconds_total Time spent running the queries of the requests",
+        "# TYPE db_duration_seconds_total counter",
+    ]
+    lines += [f"db_duration_seconds_total{labels(route['route'])} {number(route['db_ms'] / 1000)}" for route in routes]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,37 @@
+from monitoring.queries import RequestProfile, current_profile, finish
+from monitoring.metrics import route_latencies
+from monitoring.timing import server_timing
+
+
+class RequestProfilingMiddleware:
+    '''
+        ASGI middleware giving every HTTP request a profile of its database work and of its timed phases.
+        The phases measured until the response starts are sent in its Server-Timing header.
+        It only wraps the call to the app, so streamed responses are profiled until their last chunk,
+        and their duration is then added to the latency histogram of their route.
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(scope)
+        token = current_profile.set(profile)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing(profile).encode("latin-1")))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_profile.reset(token)
+            finish(profile)
+            route_latencies.observe(profile.route, profile.elapsed_ms() / 1000)
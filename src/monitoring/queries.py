@@ -0,0 +1,171 @@
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from decouple import config
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from database.database import settings
+
+logger = logging.getLogger(__name__)
+
+# Statements slower than this are logged with the route that ran them
+SLOW_QUERY_MS = config("SLOW_QUERY_MS", default=100, cast=float)
+# A request running the same statement more than this many times is probably loading rows one by one
+N_PLUS_ONE_THRESHOLD = config("N_PLUS_ONE_THRESHOLD", default=10, cast=int)
+N_PLUS_ONE_WARNINGS = config("N_PLUS_ONE_WARNINGS", default=settings.profile == "development", cast=bool)
+
+WHITESPACE = re.compile(r"\s+")
+# "IN (?, ?, ?)" has one placeholder per value, any number of values is the same statement
+IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+
+
+def statement_shape(statement: str):
+    '''Returns a statement with its whitespace and lists of placeholders collapsed, to group the same queries'''
+    return IN_LIST.sub("(?)", WHITESPACE.sub(" ", statement).strip())
+
+
+def route_label(scope: dict):
+    '''Returns the method and path template of the route matched for a request, like "GET /api/v1/episodes"'''
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return f"{scope.get('method')} (no route)"
+    if endpoint not in _route_paths:
+        paths = [route.path for route in scope["app"].routes if getattr(route, "endpoint", None) is endpoint]
+        _route_paths[endpoint] = paths[0] if paths else endpoint.__name__
+    return f"{scope.get('method')} {_route_paths[endpoint]}"
+
+
+_route_paths = {}
+
+
+class RequestProfile:
+    '''
+        Work of one request: number of queries, time spent in them and the slowest one,
+        and the time spent in the phases timed with monitoring.timing.phase
+    '''
+
+    def __init__(self, scope: dict = None):
+        self.scope = scope or {}
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.query_count = 0
+        self.total_ms = 0.0
+        self.slowest_ms = 0.0
+        self.slowest_statement = None
+        self.shapes = Counter()
+        # set by routes reading their rows chunk by chunk, which repeat the same statement on purpose
+        self.chunked = False
+
+    @property
+    def route(self):
+        # the router adds the endpoint to the scope before calling it
+        return route_label(self.scope)
+
+    def record(self, statement: str, elapsed_ms: float):
+        self.query_count += 1
+        self.total_ms += elapsed_ms
+        if elapsed_ms > self.slowest_ms:
+            self.slowest_ms = elapsed_ms
+            self.slowest_statement = statement
+        self.shapes[statement_shape(statement)] += 1
+
+    def add_phase(self, name: str, elapsed_ms: float):
+        self.phases[name] = self.phases.get(name, 0.0) + elapsed_ms
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.start) * 1000
+
+    def repeated_statements(self, threshold: int = None):
+        '''Returns the statements run more than threshold times, N_PLUS_ONE_THRESHOLD by default, with their count'''
+        if threshold is None:
+            threshold = N_PLUS_ONE_THRESHOLD
+        return [(shape, count) for shape, count in self.shapes.most_common() if count > threshold]
+
+
+# Profile of the request being handled. Routes declared with "def" run in the threadpool,
+# which copies the context, so their queries are recorded on the profile of their request.
+current_profile: ContextVar = ContextVar("current_profile", default=None)
+
+
+def mark_chunked():
+    '''Marks the current request as reading its rows chunk by chunk, its repeated statements aren't an N+1'''
+    profile = current_profile.get()
+    if profile is not None:
+        profile.chunked = True
+
+
+class RouteStats:
+    '''Database work of every route since the start of the process'''
+
+    def __init__(self):
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def add(self, profile: RequestProfile):
+        with self._lock:
+            stats = self._routes.setdefault(profile.route, {
+                "requests": 0, "queries": 0, "db_ms": 0.0, "max_queries": 0, "slowest_ms": 0.0,
+            })
+            stats["requests"] += 1
+            stats["queries"] += profile.query_count
+            stats["db_ms"] += profile.total_ms
+            stats["max_queries"] = max(stats["max_queries"], profile.query_count)
+            stats["slowest_ms"] = max(stats["slowest_ms"], profile.slowest_ms)
+
+    def snapshot(self):
+        '''Returns the stats of every route, the routes spending the most time in the database first'''
+        with self._lock:
+            routes = [dict(stats, route=route) for route, stats in self._routes.items()]
+        for stats in routes:
+            stats["queries_per_request"] = stats["queries"] / stats["requests"]
+            stats["db_ms_per_request"] = stats["db_ms"] / stats["requests"]
+        return sorted(routes, key=lambda stats: stats["db_ms"], reverse=True)
+
+    def clear(self):
+        with self._lock:
+            self._routes.clear()
+
+
+route_stats = RouteStats()
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context.query_start = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed_ms = (time.perf_counter() - context.query_start) * 1000
+    profile = current_profile.get()
+    if profile is not None:
+        profile.record(statement, elapsed_ms)
+    if elapsed_ms >= SLOW_QUERY_MS:
+        logger.warning(
+            "Slow query (%.1f ms) in %s: %s",
+            elapsed_ms, profile.route if profile is not None else "no request", statement_shape(statement)
+        )
+
+
+def install():
+    '''Times the statements of every engine, the ones run during a request are recorded on its profile'''
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+
+
+def finish(profile: RequestProfile):
+    '''
+        Adds the profile of a finished request to the route stats
+        and warns about its repeated statements, unless it read its rows chunk by chunk
+    '''
+    route_stats.add(profile)
+    if N_PLUS_ONE_WARNINGS and not profile.chunked:
+        for shape, count in profile.repeated_statements():
+            logger.warning("%s ran the same statement %d times, load the rows at once: %s", profile.route, count, shape)
+    logger.debug(
+        "%s: %d queries in %.1f ms, slowest %.1f ms",
+        profile.route, profile.query_count, profile.total_ms, profile.slowest_ms
+    )
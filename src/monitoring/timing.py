@@ -0,0 +1,30 @@
+import time
+from contextlib import contextmanager
+
+from monitoring.queries import RequestProfile, current_profile
+
+
+@contextmanager
+def phase(name: str):
+    '''Adds the time spent in the block to the phase of the current request, does nothing outside of a request'''
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_phase(name, (time.perf_counter() - start) * 1000)
+
+
+def server_timing(profile: RequestProfile):
+    '''
+        Returns the Server-Timing header value of a request: its timed phases, its queries,
+        and the time spent by the app until the response started
+    '''
+    metrics = [f"{name};dur={elapsed_ms:.2f}" for name, elapsed_ms in profile.phases.items()]
+    if profile.query_count:
+        metrics.append(f'sql;dur={profile.total_ms:.2f};desc="{profile.query_count} queries"')
+    metrics.append(f"app;dur={profile.elapsed_ms():.2f}")
+    return ", ".join(metrics)
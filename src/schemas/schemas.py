@@ -53,6 +53,21 @@ class CommentCreate(CommentBase):
     pass
 
 
+class CommentBatchCreated(BaseModel):
+    index: int
+    id: int
+
+
+class CommentBatchError(BaseModel):
+    index: int
+    detail: str
+
+
+class CommentBatchResult(BaseModel):
+    created: List[CommentBatchCreated]
+    errors: List[CommentBatchError]
+
+
 # Token
 class Token(BaseModel):
     access_token: str
@@ -83,4 +98,37 @@ class UserUpdateSelf(BaseModel):
     password: Optional[str]
 
 class UserUpdate(UserUpdateSelf):
-    id: int
\ No newline at end of file
+    id: int
+
+
+# Statistics
+class EpisodeStatistics(BaseModel):
+    episode_id: int
+    character_count: int
+
+    class Config:
+        orm_mode = True
+
+
+class SeasonStatistics(BaseModel):
+    season_number: int
+    episode_count: int
+
+    class Config:
+        orm_mode = True
+
+
+class CharacterStatistics(BaseModel):
+    character_id: int
+    episode_count: int
+
+    class Config:
+        orm_mode = True
+
+
+class CharacterDistribution(BaseModel):
+    value: str
+    character_count: int
+
+    class Config:
+        orm_mode = True
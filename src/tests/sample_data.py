@@ -0,0 +1,32 @@
+import os
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+from database.database import Base
+from import_data import import_characters, import_episodes, iter_records
+from crud.statistics import build_statistics
+
+DATA_FOLDER = os.path.join(os.path.dirname(__file__), "..", "data")
+
+
+def create_sample_engine():
+    '''
+        Returns an in-memory database holding the episodes and characters of the data folder and their statistics,
+        20 users and 1000 comments
+    '''
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    import_episodes(iter_records(os.path.join(DATA_FOLDER, "rick_morty-episodes_v1.json")), 1000, bind=engine)
+    import_characters(iter_records(os.path.join(DATA_FOLDER, "rick_morty-characters_v1.json")), 1000, bind=engine)
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "INSERT INTO users (username, email, hashed_password, disabled) VALUES (?, ?, '', 0)",
+            [(f"user{i}", f"user{i}@example.com") for i in range(1, 21)]
+        )
+        connection.exec_driver_sql(
+            "INSERT INTO comments (content, episode_id, character_id, user_id) VALUES (?, ?, ?, ?)",
+            [(f"comment {i}", i % 40 + 1, i % 660 + 1, i % 20 + 1) for i in range(1000)]
+        )
+        connection.exec_driver_sql("INSERT INTO comments_fts(comments_fts) VALUES ('rebuild')")
+        build_statistics(connection)
+    return engine
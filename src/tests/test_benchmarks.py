@@ -0,0 +1,79 @@
+import asyncio
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+
+from benchmarks.asgi_client import asgi_request
+from benchmarks.data import create_benchmark_engine, populate_dataset
+from benchmarks.http_client import decode_chunked
+from benchmarks.load import MIXES, parse_mix
+from benchmarks.suite import compare
+
+TABLES = ("episodes", "characters", "appearances", "users", "comments", "character_statistics")
+
+
+def dump(engine):
+    with engine.connect() as connection:
+        return {
+            table_name: [tuple(row) for row in connection.exec_driver_sql(f"SELECT * FROM {table_name} ORDER BY 1, 2")]
+            for table_name in TABLES
+        }
+
+
+def test_generated_dataset_is_deterministic(tmp_path):
+    dumps = []
+    for name in ("first.db", "second.db"):
+        engine = create_benchmark_engine(str(tmp_path / name))
+        populate_dataset(engine, episodes=120, characters=1500, users=50, comments=500, seed=3)
+        dumps.append(dump(engine))
+        engine.dispose()
+    assert dumps[0] == dumps[1]
+
+    data = dumps[0]
+    assert [len(data[table_name]) for table_name in ("episodes", "characters", "users", "comments")] == [
+        120, 1500, 50, 500
+    ]
+    # copies of the episodes are new seasons, every appearance points to an existing episode
+    titles = [row[1] for row in data["episodes"]]
+    assert len(set(titles)) == len(titles)
+    assert {episode_id for episode_id, _ in data["appearances"]} <= set(range(1, 121))
+
+
+def test_compare_with_baseline():
+    baseline = {
+        "list": {"p50_ms": 1.0, "throughput": 1000.0},
+        "search": {"p50_ms": 2.0, "throughput": 500.0},
+    }
+    results = {
+        "list": {"p50_ms": 1.2, "throughput": 850.0},
+        "search": {"p50_ms": 2.6, "throughput": 380.0},
+        "new": {"p50_ms": 9.0, "throughput": 100.0},
+    }
+    regressions = compare(results, baseline, threshold=0.25)
+    assert len(regressions) == 1
+    assert regressions[0].startswith("search: p50")
+
+
+def test_asgi_request_reads_streamed_responses():
+    app = FastAPI()
+
+    @app.get("/stream")
+    def stream():
+        return StreamingResponse(iter([b"a,b\n", b"1,2\n", b"3,4\n"]), media_type="text/csv")
+
+    status, headers, body = asyncio.run(asgi_request(app, "GET", "/stream"))
+    assert status == 200
+    assert headers["content-type"].startswith("text/csv")
+    assert body == b"a,b\n1,2\n3,4\n"
+
+
+def test_decode_chunked():
+    assert decode_chunked(b"4\r\nWiki\r\n6;name=value\r\npedia \r\n0\r\n\r\n") == b"Wikipedia "
+
+
+def test_parse_mix():
+    assert parse_mix("mixed") == MIXES["mixed"]
+    assert parse_mix("read=80, write=20") == {"read": 80, "write": 20}
+    assert parse_mix("login") == {"login": 1}
+    with pytest.raises(ValueError):
+        parse_mix("read=1,delete=1")
@@ -1,13 +1,23 @@
+import asyncio
+import io
+import json
+import logging
 from datetime import datetime, timedelta
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import sessionmaker
 import pytest
 
 import main
-from database.database import Base, get_db
+from crud import characters, comments, statistics, versions
+from import_data import check_incremental_schema, get_season_ep_number, iter_json_array, iter_ndjson, import_characters
+from auth import passwords
+from database.database import Base, get_db, create_configured_engine
+from database.settings import EngineSettings
+from monitoring import queries
 from models.models import Character, Episode, Appearance, Comment, User, StatusEnum, GenderEnum
+from schemas import schemas
 
 SQLALCHEMY_TEST_DATABASE_URL = "sqlite:///./test.db"
 
@@ -68,21 +78,6 @@ now = datetime.strptime(str_now, "%Y-%m-%d")
 str_yesterday = yesterday.strftime("%Y-%m-%d")
 yesterday = datetime.strptime(str_yesterday, "%Y-%m-%d")
 
-def get_season_ep_number(season_ep):
-    '''Returns an int season number and int episode number from string "S##E##"'''
-    try:
-        split_episode = season_ep.split("E")
-        season_string = split_episode[0]
-        episode_string = split_episode[-1]
-        # method to only keep digits form the string
-        season_int = int(''.join(c for c in season_string if c.isdigit()))
-        episode_int = int(''.join(c for c in episode_string if c.isdigit()))
-    except Exception as e:
-        print(e)
-        return None, None
-
-    return season_int, episode_int
-
 season_number1, episode_number1 = get_season_ep_number("S01E01")
 season_number2, episode_number2 = get_season_ep_number("S01E02")
 season_number3, episode_number3 = get_season_ep_number("S02E01")
@@ -123,6 +118,75 @@ def test_home():
 
 
 
+# Database ------------------------------------------------------------
+def test_production_engine_profile(tmp_path):
+    settings = EngineSettings("production", url=f"sqlite:///{tmp_path}/production.db")
+    assert not settings.echo
+
+    production_engine = create_configured_engine(settings)
+    with production_engine.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert connection.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+        assert connection.exec_driver_sql("PRAGMA temp_store").scalar() == 2
+    assert production_engine.pool.size() == 10
+    production_engine.dispose()
+
+
+# Import ------------------------------------------------------------
+def test_iter_json_array():
+    records = [{"id": 1, "name": "Pilot", "characters": [1, 2]}, {"id": 2, "name": "Lawnmower Dog"}, 3, "four"]
+    text = json.dumps(records, indent=2)
+    # a tiny chunk size makes elements span several reads
+    for chunk_size in (1, 7, 65536):
+        assert list(iter_json_array(io.StringIO(text), chunk_size)) == records
+    assert list(iter_json_array(io.StringIO(" [ ] "))) == []
+
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.StringIO('[{"id": 1}, {"id": 2}'), 4))
+
+    ndjson = "\n".join(json.dumps(record) for record in records) + "\n\n"
+    assert list(iter_ndjson(io.StringIO(ndjson))) == records
+
+
+def test_incremental_import(tmp_path):
+    import_engine = create_engine(f"sqlite:///{tmp_path}/import.db")
+    Base.metadata.create_all(bind=import_engine)
+    rick = {"id": 1, "name": "Rick", "status": "Alive", "species": "Human", "type": "", "gender": "Male",
+        "episode": [1, 2]}
+    morty = {"id": 2, "name": "Morty", "status": "Alive", "species": "Human", "type": "", "gender": "Male",
+        "episode": [1]}
+    assert import_characters([rick, morty], 10, bind=import_engine) == 5
+
+    # unchanged records are not written again, changed ones are updated and their appearances diffed
+    assert import_characters([rick, morty], 10, incremental=True, bind=import_engine) == 0
+    morty = dict(morty, status="Dead", episode=[2])
+    assert import_characters([rick, morty], 10, incremental=True, bind=import_engine) == 3
+
+    with import_engine.connect() as connection:
+        assert connection.exec_driver_sql("SELECT status FROM characters WHERE id = 2").scalar() == "dead"
+        appearances = connection.exec_driver_sql("SELECT episode_id, character_id FROM appearances").all()
+        assert sorted(appearances) == [(1, 1), (2, 1), (2, 2)]
+    import_engine.dispose()
+
+
+def test_incremental_import_schema_check(tmp_path):
+    import_engine = create_engine(f"sqlite:///{tmp_path}/import.db")
+    Base.metadata.create_all(bind=import_engine)
+    check_incremental_schema(bind=import_engine)
+
+    # a table created before the normalized names and comment counts existed
+    with import_engine.begin() as connection:
+        connection.exec_driver_sql("DROP TABLE episodes")
+        connection.exec_driver_sql(
+            "CREATE TABLE episodes (id INTEGER PRIMARY KEY, title VARCHAR, air_date DATE, episode_number INTEGER, "
+            "season_number INTEGER, source_hash VARCHAR(40))"
+        )
+    with pytest.raises(SystemExit) as error:
+        check_incremental_schema(bind=import_engine)
+    assert "title_normalized, comment_count" in str(error.value)
+    import_engine.dispose()
+
+
 # Episodes ------------------------------------------------------------
 def test_read_episodes():
     response = client.get("/api/v1/episodes")
@@ -162,6 +226,35 @@ def test_read_characters():
 
 
 
+def test_read_characters_with_cursor():
+    response = client.get("/api/v1/characters?cursor=&limit=2")
+    assert response.status_code == 200
+    assert [c["id"] for c in response.json()] == [1, 2]
+    next_cursor = response.headers["X-Next-Cursor"]
+
+    response = client.get(f"/api/v1/characters?cursor={next_cursor}&limit=2")
+    assert response.status_code == 200
+    assert [c["id"] for c in response.json()] == [3]
+    assert "X-Next-Cursor" not in response.headers
+
+    # offset pagination stays the default and doesn't send a cursor
+    response = client.get("/api/v1/characters?limit=2")
+    assert "X-Next-Cursor" not in response.headers
+
+    response = client.get("/api/v1/characters?cursor=notacursor")
+    assert response.status_code == 400
+
+
+def test_read_episodes_with_cursor():
+    response = client.get("/api/v1/episodes?cursor=&limit=2&season_number=1")
+    assert response.status_code == 200
+    assert [e["id"] for e in response.json()] == [1, 2]
+
+    response = client.get(f"/api/v1/episodes?cursor={response.headers['X-Next-Cursor']}&limit=2")
+    assert response.status_code == 200
+    assert [e["id"] for e in response.json()] == [3]
+
+
 # Users & Authentication -------------------------------------------------------------
 def test_create_user():
     response = client.post(
@@ -188,6 +281,12 @@ def test_create_user():
     )
     assert response.status_code == 400
 
+def test_password_hashing_pool():
+    hashed_password = asyncio.run(passwords.get_password_hash_async("string"))
+    assert hashed_password.startswith(f"$2b${passwords.BCRYPT_ROUNDS:02d}$")
+    assert asyncio.run(passwords.verify_password_async("string", hashed_password))
+    assert not asyncio.run(passwords.verify_password_async("wrong_string", hashed_password))
+
 @pytest.fixture(scope='function')
 def create_test_user():
 
@@ -236,6 +335,28 @@ def create_test_access_token(create_test_user):
 
     return auth_header
 
+@pytest.fixture(scope='function')
+def auth_headers():
+
+    '''fixture function returning a function that signs up a new user with a username, logs it in
+    and returns its authorization header, for tests that need a user of their own'''
+
+    def sign_up_and_log_in(username):
+        client.post(
+            "/api/v1/signup",
+            json={"id": 1, "username": username, "email": f"{username}@example.com", "password": "string"}
+        )
+        response = client.post(
+            "/api/v1/token",
+            data={"username": username, "password": "string"},
+            headers={'Content-Type': 'application/x-www-form-urlencoded'}
+        )
+        assert response.status_code == 200
+        return {"Authorization": "Bearer " + response.json()["access_token"]}
+
+    return sign_up_and_log_in
+
+
 # no need to test the actual login with test_user since our fixture will
 # but we still test for erroneous requests
 def test_login_for_access_token():
@@ -448,6 +569,50 @@ def test_update_comment():
     assert response.status_code == 422
 
 
+def test_search_comments():
+    response = client.get("/api/v1/comments?q=comment 2")
+    assert response.status_code == 200
+    assert [c["id"] for c in response.json()] == [2]
+
+    response = client.get("/api/v1/comments?q=COMMENT")
+    assert sorted(c["id"] for c in response.json()) == [2, 3]
+
+    # the index follows updates
+    response = client.get("/api/v1/comments?q=new")
+    assert [c["id"] for c in response.json()] == [1]
+    response = client.get("/api/v1/comments?q=comment 1")
+    assert response.json() == []
+
+    # FTS5 syntax is searched as plain words
+    response = client.get('/api/v1/comments?q="comment AND (')
+    assert response.status_code == 200
+
+    response = client.get("/api/v1/comments?q=comment&cursor=")
+    assert response.status_code == 400
+
+
+def test_search_ranks_the_newest_matches(monkeypatch):
+    search_engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=search_engine)
+    db = sessionmaker(bind=search_engine)()
+    contents = ["portal portal portal", "portal gun and other words", "another portal in other words"]
+    for content in contents:
+        db.add(Comment(content=content, episode_id=1, user_id=1))
+    db.flush()
+    comments.index_comments(db, [(comment.id, comment.content) for comment in db.query(Comment)])
+    db.commit()
+
+    # the oldest comment is the best match, it's ranked while it's one of the newest SEARCH_CANDIDATES matches
+    monkeypatch.setattr(comments, "SEARCH_CANDIDATES", 3)
+    assert [row.id for row in comments.get_comments(db, limit=1, q="portal")] == [1]
+    # past the cutoff, it's never returned and the best of the newest matches comes first
+    monkeypatch.setattr(comments, "SEARCH_CANDIDATES", 2)
+    assert 1 not in [row.id for row in comments.get_comments(db, limit=2, q="portal")]
+    # pages further than the candidates rank enough matches to be filled
+    assert [row.id for row in comments.get_comments(db, skip=2, limit=1, q="portal")]
+    db.close()
+
+
 def test_delete_comment():
     response = client.delete("/api/v1/comments/1")
     assert response.status_code == 204
@@ -456,12 +621,355 @@ def test_delete_comment():
     response = client.delete("/api/v1/comments/54")
     assert response.status_code == 404
 
+    # the index follows deletions
+    response = client.get("/api/v1/comments?q=new")
+    assert response.json() == []
+
 
 def test_export_comments():
     response = client.get("/api/v1/comments/export_csv")
     assert response.status_code == 200
+    lines = response.text.splitlines()
+    assert lines[0] == "id,content,episode_id,character_id,user_id"
+    assert len(lines) == 3
+
+    # the export is built one chunk of rows at a time
+    chunks = list(comments.export_comments_csv(session, chunk_size=1))
+    assert len(chunks) == 2
+    assert "".join(chunks).splitlines() == lines
+
+
+def test_export_comments_is_not_an_n_plus_one(monkeypatch, caplog):
+    export_comments_csv = comments.export_comments_csv
+    monkeypatch.setattr(comments, "export_comments_csv", lambda db: export_comments_csv(db, chunk_size=1))
+    monkeypatch.setattr(queries, "N_PLUS_ONE_WARNINGS", True)
+    monkeypatch.setattr(queries, "N_PLUS_ONE_THRESHOLD", 1)
+    queries.route_stats.clear()
+    with caplog.at_level(logging.WARNING, logger=queries.logger.name):
+        response = client.get("/api/v1/comments/export_csv")
+    assert response.status_code == 200
+    # the same keyset query ran for every chunk, above the threshold, without a warning
+    stats = {route["route"]: route for route in queries.route_stats.snapshot()}
+    assert stats["GET /api/v1/comments/export_csv"]["queries"] > 2
+    assert not [record for record in caplog.records if "ran the same statement" in record.getMessage()]
 
 
 def test_delete_user_self(create_test_access_token):
     response = client.delete("/api/v1/users/me", headers=create_test_access_token)
     assert response.status_code == 204
+
+
+def test_authenticated_user_cache(auth_headers):
+    auth_header = auth_headers("cached_user")
+
+    response = client.get("/api/v1/users/me", headers=auth_header)
+    assert response.status_code == 200
+    assert response.json()["email"] == "cached_user@example.com"
+    user_id = response.json()["id"]
+
+    # changing the account invalidates the cached user right away
+    response = client.put("/api/v1/users", json={"id": user_id, "email": "new_cached_user@example.com"})
+    response = client.get("/api/v1/users/me", headers=auth_header)
+    assert response.json()["email"] == "new_cached_user@example.com"
+
+    response = client.put("/api/v1/users", json={"id": user_id, "disabled": True})
+    response = client.get("/api/v1/users/me", headers=auth_header)
+    assert response.status_code == 400
+
+    client.delete(f"/api/v1/users?id={user_id}")
+    response = client.get("/api/v1/users/me", headers=auth_header)
+    assert response.status_code == 401
+
+
+def test_conditional_list_requests():
+    response = client.get("/api/v1/episodes?limit=5")
+    etag = response.headers["etag"]
+    response = client.get("/api/v1/episodes?limit=5", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    # another page is another representation
+    response = client.get("/api/v1/episodes?limit=6", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+
+    response = client.get("/api/v1/comments")
+    etag, comment_id = response.headers["etag"], response.json()[0]["id"]
+    last_modified = response.headers["last-modified"]
+    assert client.get("/api/v1/comments", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/api/v1/comments", headers={"If-Modified-Since": last_modified}).status_code == 304
+
+    # a write changes the version of the comments right away in this process
+    client.put(f"/api/v1/comments/{comment_id}", json={"content": "changed"})
+    response = client.get("/api/v1/comments", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+
+
+def test_list_payloads_match_schemas():
+    # list routes encode plain rows without their response_model, the payload must still follow it
+    client.post(
+        "/api/v1/signup",
+        json={"id": 1, "username": "listed_user", "email": "listed_user@example.com", "password": "string"}
+    )
+    for url, schema in (
+        ("/api/v1/episodes", schemas.Episode),
+        ("/api/v1/characters", schemas.Character),
+        ("/api/v1/comments", schemas.Comment),
+        ("/api/v1/users", schemas.User),
+    ):
+        response = client.get(url, params={"cursor": ""})
+        assert response.status_code == 200
+        payload = response.json()
+        assert payload
+        assert payload == [json.loads(schema(**item).json()) for item in payload]
+
+
+def test_sparse_fieldsets():
+    response = client.get("/api/v1/characters", params={"fields": "id,name", "limit": 3})
+    assert response.status_code == 200
+    assert [list(item) for item in response.json()] == [["id", "name"]] * 3
+
+    # cursor columns are selected to build the next cursor but only the fields asked for are sent
+    response = client.get("/api/v1/episodes", params={"fields": "title", "limit": 2, "cursor": ""})
+    assert [list(item) for item in response.json()] == [["title"]] * 2
+    next_page = client.get(
+        "/api/v1/episodes", params={"fields": "title", "limit": 2, "cursor": response.headers["x-next-cursor"]}
+    )
+    assert next_page.status_code == 200
+    assert next_page.json() and next_page.json() != response.json()
+
+    response = client.get("/api/v1/episodes", params={"fields": "id,hashed_password"})
+    assert response.status_code == 400
+    assert "hashed_password" in response.json()["detail"]
+
+    # a list without any name asks for all the fields
+    for fields in (",", " , "):
+        for url in ("/api/v1/characters", "/api/v1/comments", "/api/v1/users"):
+            response = client.get(url, params={"fields": fields, "limit": 1})
+            assert response.status_code == 200
+            assert response.json() == client.get(url, params={"limit": 1}).json()
+        response = client.get("/api/v1/episodes", params={"fields": fields, "limit": 2, "cursor": ""})
+        assert response.status_code == 200
+        assert response.json() == client.get("/api/v1/episodes", params={"limit": 2, "cursor": ""}).json()
+        assert response.json()[0]
+
+    # the query itself only selects the fields asked for
+    db = TestingSessionLocal()
+    assert characters.get_characters(db, limit=1, fields="name")[0]._fields == ("name",)
+    assert comments.get_comments(db, limit=1, cursor="", fields="content")[0]._fields == ("content", "id")
+    db.close()
+
+
+def test_batch_get_by_ids():
+    response = client.get("/api/v1/episodes", params={"ids": "3,1,3,2"})
+    assert response.status_code == 200
+    # duplicates are dropped and the order of the request is kept
+    assert [episode["id"] for episode in response.json()] == [3, 1, 2]
+
+    # unknown ids are left out, other filters still apply
+    response = client.get("/api/v1/characters", params={"ids": "2,999999,1", "fields": "id"})
+    assert response.json() == [{"id": 2}, {"id": 1}]
+    response = client.get("/api/v1/episodes", params={"ids": "1,2,3", "season_number": "9"})
+    assert response.json() == []
+
+    assert client.get("/api/v1/episodes", params={"ids": "1,two"}).status_code == 400
+    assert client.get("/api/v1/episodes", params={"ids": "1", "cursor": ""}).status_code == 400
+    too_many = ",".join(str(id_) for id_ in range(1, 102))
+    assert client.get("/api/v1/comments", params={"ids": too_many}).status_code == 400
+
+
+def count_queries(url, params):
+    '''Returns a response and the number of SQL statements run to build it'''
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    # the versions of the tables are cached, start from an empty cache for every request to count the same work
+    versions.version_cache.invalidate()
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        response = client.get(url, params=params)
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+    return response, len(statements)
+
+
+def test_include_relations():
+    response = client.get("/api/v1/episodes", params={"ids": "1", "include": "characters"})
+    assert response.status_code == 200
+    episode = response.json()[0]
+    assert 1 in [character["id"] for character in episode["characters"]]
+    assert set(episode["characters"][0]) == set(schemas.Character.__fields__)
+
+    response = client.get("/api/v1/characters", params={"ids": "1", "include": "episodes", "fields": "name"})
+    character = response.json()[0]
+    assert set(character) == {"name", "episodes"}
+    assert 1 in [episode["id"] for episode in character["episodes"]]
+
+    assert client.get("/api/v1/episodes", params={"include": "comments"}).status_code == 400
+
+    # related rows are loaded for the whole page at once: a bigger page runs the same number of queries
+    for url, include in (("/api/v1/episodes", "characters"), ("/api/v1/characters", "episodes")):
+        small_page, small_page_queries = count_queries(url, {"limit": 1, "include": include})
+        big_page, big_page_queries = count_queries(url, {"limit": 20, "include": include})
+        assert len(big_page.json()) > len(small_page.json())
+        assert big_page_queries == small_page_queries
+        without_include = count_queries(url, {"limit": 20})[1]
+        assert big_page_queries == without_include + 1
+
+
+def test_comment_counts(auth_headers):
+    auth_header = auth_headers("counted_user")
+
+    def counts():
+        episode = client.get("/api/v1/episodes", params={"ids": "2", "fields": "comment_count"}).json()[0]
+        character = client.get("/api/v1/characters", params={"ids": "3", "fields": "comment_count"}).json()[0]
+        user = client.get("/api/v1/users", params={"username": "counted_user", "fields": "comment_count"}).json()[0]
+        return episode["comment_count"], character["comment_count"], user["comment_count"]
+
+    before = counts()
+    created = [
+        client.post(
+            "/api/v1/comments", json={"episode_id": 2, "character_id": 3, "content": "counted", "user_id": 0},
+            headers=auth_header
+        ).json()["id"]
+        for _ in range(3)
+    ]
+    assert counts() == (before[0] + 3, before[1] + 3, before[2] + 3)
+    client.delete(f"/api/v1/comments/{created[0]}")
+    assert counts() == (before[0] + 2, before[1] + 2, before[2] + 2)
+
+    # the counters match a count of the comments
+    session = TestingSessionLocal()
+    assert session.query(Comment).filter(Comment.episode_id == 2).count() == before[0] + 2
+    session.close()
+    with engine.begin() as connection:
+        comments.recount_comments(connection)
+    assert counts() == (before[0] + 2, before[1] + 2, before[2] + 2)
+
+    response = client.get("/api/v1/episodes", params={"sort": "-comment_count", "fields": "id,comment_count"})
+    episode_counts = [episode["comment_count"] for episode in response.json()]
+    assert episode_counts == sorted(episode_counts, reverse=True)
+    assert response.json()[0] == {"id": 2, "comment_count": before[0] + 2}
+    assert "comment_count" not in client.get("/api/v1/episodes").json()[0]
+
+    assert client.get("/api/v1/users", params={"sort": "comment_count"}).status_code == 200
+    assert client.get("/api/v1/episodes", params={"sort": "title"}).status_code == 400
+    assert client.get("/api/v1/characters", params={"sort": "comment_count", "cursor": ""}).status_code == 400
+
+
+def test_statistics_routes():
+    with engine.begin() as connection:
+        statistics.build_statistics(connection)
+        versions.bump_versions(connection, "statistics")
+    versions.version_cache.invalidate()
+
+    response = client.get("/api/v1/stats/episodes", params={"ids": "1"})
+    assert response.status_code == 200
+    session = TestingSessionLocal()
+    assert response.json() == [{
+        "episode_id": 1,
+        "character_count": session.query(Appearance).filter(Appearance.episode_id == 1).count()
+    }]
+    session.close()
+    assert client.get("/api/v1/stats/characters", params={"limit": 2}).json()[0]["character_id"] == 1
+    assert client.get("/api/v1/stats/seasons").json()[0]["season_number"] == 1
+
+    response = client.get("/api/v1/stats/characters/status")
+    assert {row["value"] for row in response.json()} <= {"alive", "dead", "unknown"}
+    cached = client.get("/api/v1/stats/characters/status", headers={"If-None-Match": response.headers["etag"]})
+    assert cached.status_code == 304
+    assert client.get("/api/v1/stats/characters/name").status_code == 404
+
+
+def test_server_timing_and_metrics(auth_headers):
+    auth_header = auth_headers("timed_user")
+    response = client.post(
+        "/api/v1/token",
+        data={"username": "timed_user", "password": "wrong password"},
+        headers={'Content-Type': 'application/x-www-form-urlencoded'}
+    )
+    assert response.status_code == 401
+    assert "bcrypt;dur=" in response.headers["server-timing"]
+
+    response = client.get("/api/v1/users/me/comments", headers=auth_header)
+    assert response.status_code == 200
+    phases = {metric.split(";")[0] for metric in response.headers["server-timing"].split(", ")}
+    assert phases == {"jwt", "sql", "serialization", "app"}
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    route = 'method="GET",route="/api/v1/users/me/comments"'
+    assert f'http_request_duration_seconds_count{{{route}}} ' in response.text
+    assert f'http_request_duration_quantile_seconds{{{route},quantile="0.99"}} ' in response.text
+    assert f'db_queries_total{{{route}}} ' in response.text
+
+
+def test_create_comments_batch(auth_headers):
+    auth_header = auth_headers("batch_user")
+    items = [
+        {"content": "batched dimension", "episode_id": 1, "user_id": 0},
+        {"content": "batched without target", "user_id": 0},
+        {"content": "batched dimension", "character_id": 1, "episode_id": 1, "user_id": 0},
+        {"content": "batched on a missing episode", "episode_id": 100000, "user_id": 0},
+    ]
+
+    assert client.post("/api/v1/comments/batch", json=items).status_code == 401
+
+    session = TestingSessionLocal()
+    episode_count = session.query(Episode.comment_count).filter(Episode.id == 1).scalar()
+    session.close()
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        response = client.post("/api/v1/comments/batch", json=items, headers=auth_header)
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+    assert response.status_code == 201
+    result = response.json()
+    assert [created["index"] for created in result["created"]] == [0, 2]
+    assert [error["index"] for error in result["errors"]] == [1, 3]
+    assert result["errors"][0]["detail"] == comments.MISSING_TARGET
+    assert result["errors"][1]["detail"] == "Episode 100000 does not exist"
+    # one row per comment, and their search index rows in one statement
+    assert len([statement for statement in statements if statement.startswith("INSERT INTO comments ")]) == 2
+    assert len([statement for statement in statements if statement.startswith("INSERT INTO comments_fts")]) == 1
+
+    ids = [created["id"] for created in result["created"]]
+    rows = client.get("/api/v1/comments", params={"ids": ",".join(map(str, ids))}).json()
+    assert [row["content"] for row in rows] == ["batched dimension", "batched dimension"]
+    assert {row["user_id"] for row in rows} == {client.get("/api/v1/users/me", headers=auth_header).json()["id"]}
+    searched = client.get("/api/v1/comments", params={"q": "batched dimension"}).json()
+    assert sorted(row["id"] for row in searched) == sorted(ids)
+    session = TestingSessionLocal()
+    assert session.query(Episode.comment_count).filter(Episode.id == 1).scalar() == episode_count + 2
+    session.close()
+
+    response = client.post(
+        "/api/v1/comments/batch", json=[{}] * (comments.MAX_COMMENT_BATCH + 1), headers=auth_header
+    )
+    # the length is part of the schema, checked before the comments, which aren't validated
+    assert response.status_code == 422
+    assert [error["loc"] for error in response.json()["detail"]] == [["body"]]
+    assert client.post("/api/v1/comments/batch", json=[], headers=auth_header).status_code == 400
+    response = client.post("/api/v1/comments/batch", json=[items[1]], headers=auth_header)
+    assert response.status_code == 400
+    assert response.json() == {"created": [], "errors": [{"index": 0, "detail": comments.MISSING_TARGET}]}
+    # the comments are parsed by their schema, which is documented
+    bad_id = {"content": "batched with a bad id", "episode_id": "one", "user_id": 0}
+    response = client.post("/api/v1/comments/batch", json=[items[0], bad_id], headers=auth_header)
+    assert response.status_code == 422
+    # a schema error fails the whole batch, located by the index of the comment
+    assert response.json()["detail"][0]["loc"] == ["body", 1, "episode_id"]
+    response = client.post("/api/v1/comments/batch", json=[{"episode_id": 1, "user_id": 0}], headers=auth_header)
+    assert response.json()["detail"][0]["loc"] == ["body", 0, "content"]
+    request_body = main.app.openapi()["paths"]["/api/v1/comments/batch"]["post"]["requestBody"]
+    assert request_body["content"]["application/json"]["schema"]["items"] == {
+        "$ref": "#/components/schemas/CommentCreate"
+    }
+    assert request_body["content"]["application/json"]["schema"]["maxItems"] == comments.MAX_COMMENT_BATCH
@@ -0,0 +1,120 @@
+import logging
+import math
+import time
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+from monitoring import metrics, queries
+from monitoring.middleware import RequestProfilingMiddleware
+from monitoring.timing import phase
+
+engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+with engine.begin() as connection:
+    connection.exec_driver_sql("CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT)")
+    connection.exec_driver_sql("INSERT INTO items (name) VALUES (?)", [(f"item {i}",) for i in range(20)])
+
+app = FastAPI()
+app.add_middleware(RequestProfilingMiddleware)
+queries.install()
+
+
+@app.get("/items")
+def read_items():
+    with engine.connect() as connection:
+        return [row.name for row in connection.exec_driver_sql("SELECT id, name FROM items WHERE id IN (?, ?)", (1, 2))]
+
+
+@app.get("/items/one_by_one")
+def read_items_one_by_one():
+    # the N+1 pattern: one query per row
+    with engine.connect() as connection:
+        return [
+            connection.exec_driver_sql("SELECT name FROM items WHERE id = ?", (id_,)).scalar()
+            for id_ in range(1, 21)
+        ]
+
+
+@app.get("/items/timed")
+async def read_items_timed():
+    with phase("work"):
+        time.sleep(0.01)
+    return []
+
+
+client = TestClient(app)
+
+
+def test_statement_shape():
+    shape = "SELECT * FROM items WHERE id IN (?)"
+    assert queries.statement_shape("SELECT *\n  FROM items WHERE id IN (?, ?,?)") == shape
+    assert queries.statement_shape("SELECT * FROM items WHERE id IN (?)") == shape
+
+
+def test_queries_are_attributed_to_their_route():
+    queries.route_stats.clear()
+    client.get("/items")
+    client.get("/items")
+    client.get("/items/one_by_one")
+
+    stats = {route["route"]: route for route in queries.route_stats.snapshot()}
+    # "def" routes run in the threadpool, their queries are still recorded on their request
+    assert stats["GET /items"]["requests"] == 2
+    assert stats["GET /items"]["queries"] == 2
+    assert stats["GET /items/one_by_one"]["max_queries"] == 20
+    db_ms = [route["db_ms"] for route in queries.route_stats.snapshot()]
+    assert db_ms == sorted(db_ms, reverse=True)
+
+
+def test_slow_queries_and_repeated_statements_are_logged(monkeypatch, caplog):
+    monkeypatch.setattr(queries, "SLOW_QUERY_MS", 0)
+    monkeypatch.setattr(queries, "N_PLUS_ONE_WARNINGS", True)
+    with caplog.at_level(logging.WARNING, logger=queries.logger.name):
+        client.get("/items/one_by_one")
+    messages = [record.getMessage() for record in caplog.records]
+    assert any(message.startswith("Slow query") and "GET /items/one_by_one" in message for message in messages)
+    assert any("ran the same statement 20 times" in message for message in messages)
+
+    caplog.clear()
+    monkeypatch.setattr(queries, "SLOW_QUERY_MS", 1000)
+    with caplog.at_level(logging.WARNING, logger=queries.logger.name):
+        client.get("/items")
+    assert not caplog.records
+
+
+def test_server_timing_header():
+    timing = client.get("/items").headers["server-timing"]
+    assert timing.startswith('sql;dur=')
+    assert 'desc="1 queries"' in timing
+    assert timing.split(", ")[-1].startswith("app;dur=")
+
+    metric, = [metric for metric in client.get("/items/timed").headers["server-timing"].split(", ") if "work" in metric]
+    assert float(metric.split("dur=")[1]) >= 10
+
+
+def test_latency_histogram_quantiles():
+    histogram = metrics.LatencyHistogram(buckets=(0.1, 0.2, 0.4))
+    assert math.isnan(histogram.quantile(0.5))
+    for seconds in [0.05] * 50 + [0.15] * 45 + [0.3] * 4 + [1.0]:
+        histogram.observe(seconds)
+    assert histogram.counts == [50, 45, 4, 1]
+    assert histogram.quantile(0.5) == 0.1
+    assert 0.1 < histogram.quantile(0.95) <= 0.2
+    assert 0.2 < histogram.quantile(0.99) <= 0.4
+    # a quantile beyond the last bucket is its upper bound
+    assert histogram.quantile(1) == 0.4
+
+
+def test_metrics_are_rendered_per_route():
+    metrics.route_latencies.clear()
+    queries.route_stats.clear()
+    client.get("/items")
+    client.get("/items")
+
+    text = metrics.render(metrics.route_latencies, queries.route_stats)
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/items",le="+Inf"} 2' in text
+    assert 'http_request_duration_seconds_count{method="GET",route="/items"} 2' in text
+    assert 'http_request_duration_quantile_seconds{method="GET",route="/items",quantile="0.5"} ' in text
+    assert 'db_queries_total{method="GET",route="/items"} 2' in text
+    assert text.endswith("\n")
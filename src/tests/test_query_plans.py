@@ -0,0 +1,139 @@
+import itertools
+import re
+from datetime import date
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+from crud import characters, comments, episodes, statistics, users
+from models.models import GenderEnum, StatusEnum
+from tests.sample_data import create_sample_engine
+
+engine = create_sample_engine()
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Every filter of the crud list functions, with a value matching some rows
+CHARACTER_FILTERS = {
+    "status": StatusEnum.alive,
+    "species": "Human",
+    "character_type": "Parasite",
+    "gender": GenderEnum.female,
+    "episode_name": "Pilot",
+}
+EPISODE_FILTERS = {
+    "before_air_date": date(2015, 1, 1),
+    "after_air_date": date(2014, 1, 1),
+    "episode_number": 1,
+    "season_number": 1,
+    "character_name": "Rick Sanchez",
+}
+COMMENT_FILTERS = {
+    "episode_id": 1,
+    "character_id": 1,
+    "user_id": 1,
+    "q": "comment",
+}
+USER_FILTERS = {
+    "username": "user1",
+}
+
+# "SCAN episodes" is a full table scan, "SCAN episodes USING INDEX ..." or "SEARCH ..." are not
+FULL_SCAN = re.compile(r"^SCAN (?:TABLE )?(?P<table>\w+)(?: AS \w+)?$")
+
+
+def query_plans(function, *args, **kwargs):
+    '''Calls a crud function and returns the query plan details of every statement it ran'''
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", capture)
+    db = TestingSessionLocal()
+    try:
+        function(db, *args, **kwargs)
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+        db.close()
+
+    plans = []
+    with engine.connect() as connection:
+        for statement, parameters in statements:
+            plans.extend(row[3] for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters))
+    return plans
+
+
+def scanned_tables(plans):
+    # subqueries materialized by the plan hold the rows they selected, not a table
+    materialized = {plan.split()[-1] for plan in plans if plan.startswith("MATERIALIZE ")}
+    return [
+        match.group("table") for match in map(FULL_SCAN.match, plans)
+        if match and match.group("table") not in materialized
+    ]
+
+
+def test_name_lookups_use_an_index():
+    db = TestingSessionLocal()
+    assert characters.get_characters(db, episode_name="pILOT")
+    assert episodes.get_episodes(db, character_name="rick sanchez")
+    db.close()
+
+    assert "episodes" not in scanned_tables(query_plans(characters.get_characters, episode_name="pilot"))
+    assert "characters" not in scanned_tables(query_plans(episodes.get_episodes, character_name="Rick Sanchez"))
+
+
+def filter_combinations(filters):
+    '''Yields every non empty combination of filters, listing without any filter is expected to scan'''
+    for size in range(1, len(filters) + 1):
+        for names in itertools.combinations(filters, size):
+            yield {name: filters[name] for name in names}
+
+
+def check_no_full_scan(function, filters, paginations=({}, {"cursor": ""})):
+    failures = []
+    for combination in filter_combinations(filters):
+        for pagination in paginations:
+            plans = query_plans(function, **combination, **pagination)
+            if scanned_tables(plans):
+                failures.append(f"{function.__name__}({combination}, {pagination}): {plans}")
+    assert not failures, "\n".join(failures)
+
+
+def test_character_filters_use_indexes():
+    check_no_full_scan(characters.get_characters, CHARACTER_FILTERS)
+
+
+def test_episode_filters_use_indexes():
+    check_no_full_scan(episodes.get_episodes, EPISODE_FILTERS)
+
+
+def test_comment_filters_use_indexes():
+    # search results can't be paged with a cursor
+    check_no_full_scan(comments.get_comments, {name: value for name, value in COMMENT_FILTERS.items() if name != "q"})
+    check_no_full_scan(comments.get_comments, COMMENT_FILTERS, paginations=({},))
+
+
+def test_user_filters_use_indexes():
+    check_no_full_scan(users.get_user, USER_FILTERS)
+    check_no_full_scan(users.get_single_user, USER_FILTERS, paginations=({},))
+
+
+def test_batch_gets_use_the_primary_key():
+    for function in (characters.get_characters, episodes.get_episodes, comments.get_comments, users.get_user):
+        plans = query_plans(function, ids="5,3,8")
+        assert not scanned_tables(plans), plans
+
+
+def test_sorted_lists_use_an_index():
+    for function in (characters.get_characters, episodes.get_episodes, users.get_user):
+        for sort in ("comment_count", "-comment_count"):
+            plans = query_plans(function, sort=sort)
+            assert not scanned_tables(plans), plans
+            assert not [plan for plan in plans if "TEMP B-TREE" in plan], plans
+
+
+def test_statistics_are_read_by_primary_key():
+    assert not scanned_tables(query_plans(statistics.get_episode_statistics, ids="1,2"))
+    assert not scanned_tables(query_plans(statistics.get_character_statistics, ids="1,2"))
+    plans = query_plans(statistics.get_character_distribution, "status")
+    assert not scanned_tables(plans), plans
+    assert not [plan for plan in plans if "TEMP B-TREE" in plan], plans
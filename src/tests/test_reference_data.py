@@ -0,0 +1,158 @@
+import itertools
+from datetime import date
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from crud import characters, episodes, pagination, reference_data, relations
+from crud.reference_data import ReferenceData
+from crud.versions import REFERENCE_TABLES, bump_versions
+from database.database import Base
+from models.models import GenderEnum, StatusEnum
+from tests.sample_data import create_sample_engine
+
+engine = create_sample_engine()
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+CHARACTER_FILTERS = {
+    "status": [StatusEnum.alive, StatusEnum.unknown],
+    "species": ["Human", "Alien", "Nope"],
+    "character_type": ["Parasite"],
+    "gender": [GenderEnum.female],
+    "episode_name": ["Pilot", "pilot", "Total Rickall", "Nope"],
+}
+EPISODE_FILTERS = {
+    "before_air_date": [date(2015, 1, 1), date(2017, 9, 1)],
+    "after_air_date": [date(2014, 1, 1), date(2015, 8, 2)],
+    "episode_number": [1, 4],
+    "season_number": ["1", "03", "x"],
+    "character_name": ["Rick Sanchez", "morty smith", "Nope"],
+}
+
+
+def filter_combinations(filters):
+    '''Yields every combination of up to two filters with each of their values'''
+    for size in range(3):
+        for names in itertools.combinations(filters, size):
+            for values in itertools.product(*(filters[name] for name in names)):
+                yield dict(zip(names, values))
+
+
+def load_store(db):
+    return ReferenceData.load(db, reference_data.versions.reference_version(db))
+
+
+def pages(function, cursor_columns, limit, **filters):
+    '''Returns the ids of every page of a list function paged with a cursor'''
+    result, cursor = [], ""
+    while cursor is not None:
+        rows = function(limit=limit, cursor=cursor, **filters)
+        result.append([row.id for row in rows])
+        cursor = pagination.next_cursor(rows, limit, cursor_columns)
+    return result
+
+
+def test_episodes_match_sql():
+    db = TestingSessionLocal()
+    store = load_store(db)
+    for filters in filter_combinations(EPISODE_FILTERS):
+        sql_rows = episodes.get_episodes(db, limit=1000, **filters)
+        memory_rows = store.get_episodes(limit=1000, **filters)
+        assert sorted(row.id for row in memory_rows) == sorted(row.id for row in sql_rows), filters
+        assert pages(store.get_episodes, episodes.CURSOR_COLUMNS, 7, **filters) == pages(
+            lambda **kwargs: episodes.get_episodes(db, **kwargs), episodes.CURSOR_COLUMNS, 7, **filters
+        ), filters
+        ids = [5, 2, 40, 1, 31, 999]
+        assert [row.id for row in store.get_episodes(ids=ids, **filters)] == [
+            row.id for row in episodes.get_episodes(db, ids=",".join(map(str, ids)), **filters)
+        ], filters
+    row = store.get_episodes(limit=1)[0]
+    assert row._asdict() == episodes.get_episodes(db, limit=1)[0]._asdict()
+    db.close()
+
+
+def test_characters_match_sql():
+    db = TestingSessionLocal()
+    store = load_store(db)
+    for filters in filter_combinations(CHARACTER_FILTERS):
+        sql_rows = characters.get_characters(db, limit=1000, **filters)
+        memory_rows = store.get_characters(limit=1000, **filters)
+        assert sorted(row.id for row in memory_rows) == sorted(row.id for row in sql_rows), filters
+        assert pages(store.get_characters, characters.CURSOR_COLUMNS, 50, **filters) == pages(
+            lambda **kwargs: characters.get_characters(db, **kwargs), characters.CURSOR_COLUMNS, 50, **filters
+        ), filters
+        ids = [300, 1, 2, 35, 180, 999999]
+        assert [row.id for row in store.get_characters(ids=ids, **filters)] == [
+            row.id for row in characters.get_characters(db, ids=",".join(map(str, ids)), **filters)
+        ], filters
+    db.close()
+
+
+def test_reload_after_import(monkeypatch):
+    monkeypatch.setattr(reference_data, "ENABLED", True)
+    monkeypatch.setattr(reference_data, "CHECK_SECONDS", 0)
+    monkeypatch.setattr(reference_data, "_store", None)
+    db = TestingSessionLocal()
+
+    store = reference_data.current(db)
+    assert store is not None
+    assert reference_data.current(db) is store
+    assert [row.id for row in episodes.get_episodes(db, limit=3)] == [1, 2, 3]
+
+    with engine.begin() as connection:
+        bump_versions(connection, *REFERENCE_TABLES)
+    reloaded = reference_data.current(db)
+    assert reloaded is not store
+    assert reloaded.version != store.version
+    db.close()
+
+
+def test_relations_match_sql():
+    db = TestingSessionLocal()
+    store = load_store(db)
+    episode_ids = list(range(1, 45))
+    assert store.episodes_characters(episode_ids) == {
+        id_: relations.get_episodes_characters(db, episode_ids).get(id_, []) for id_ in episode_ids
+    }
+    character_ids = list(range(1, 700, 7))
+    assert store.characters_episodes(character_ids) == {
+        id_: relations.get_characters_episodes(db, character_ids).get(id_, []) for id_ in character_ids
+    }
+    db.close()
+
+
+def test_cursor_pages_over_undated_episodes():
+    undated_engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=undated_engine)
+    with undated_engine.begin() as connection:
+        connection.exec_driver_sql(
+            "INSERT INTO episodes (id, title, air_date, episode_number, season_number) VALUES (?, ?, ?, 1, ?)",
+            [
+                (1, "Dated", "2014-01-01", 1), (2, "Undated", None, 1), (3, "Earlier", "2013-01-01", 1),
+                (4, "Undated too", None, 1), (5, "Other season", "2012-01-01", 2),
+            ]
+        )
+    db = sessionmaker(bind=undated_engine)()
+    store = load_store(db)
+    # undated episodes come first, like NULL in SQLite's order
+    expected = [[2, 4], [5, 3], [1]]
+    assert pages(lambda **kwargs: episodes.get_episodes(db, **kwargs), episodes.CURSOR_COLUMNS, 2) == expected
+    assert pages(store.get_episodes, episodes.CURSOR_COLUMNS, 2) == expected
+    assert pages(lambda **kwargs: episodes.get_episodes(db, **kwargs), episodes.CURSOR_COLUMNS, 1) == [
+        [2], [4], [5], [3], [1], []
+    ]
+    # filtered pages are bisected among the matching episodes only
+    expected = [[2], [4], [3], [1], []]
+    sql_get_episodes = lambda **kwargs: episodes.get_episodes(db, **kwargs)
+    assert pages(sql_get_episodes, episodes.CURSOR_COLUMNS, 1, season_number="1") == expected
+    assert pages(store.get_episodes, episodes.CURSOR_COLUMNS, 1, season_number="1") == expected
+    db.close()
+
+
+def test_invalid_cursor_values():
+    for values in ([None, None], [[1], 2], ["2014-01-01", {"id": 1}], ["2014-01-01", "1"], ["2014-01-01", True]):
+        with pytest.raises(HTTPException) as error:
+            pagination.decode_cursor(pagination.encode_cursor(values), episodes.CURSOR_COLUMNS)
+        assert error.value.status_code == 400, values
+    assert pagination.decode_cursor(pagination.encode_cursor([None, 3]), episodes.CURSOR_COLUMNS) == [None, 3]
@@ -0,0 +1,55 @@
+from collections import Counter
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from crud import statistics
+from database.database import Base
+from models.models import Appearance, Character, Episode
+from tests.sample_data import create_sample_engine
+
+engine = create_sample_engine()
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def test_statistics_match_aggregates():
+    db = TestingSessionLocal()
+    appearances = db.query(Appearance.episode_id, Appearance.character_id).all()
+    characters = db.query(Character).all()
+
+    characters_per_episode = Counter(episode_id for episode_id, _ in appearances)
+    assert {
+        row.episode_id: row.character_count for row in statistics.get_episode_statistics(db, limit=1000)
+    } == {episode_id: characters_per_episode[episode_id] for episode_id, in db.query(Episode.id)}
+
+    episodes_per_character = Counter(character_id for _, character_id in appearances)
+    assert {
+        row.character_id: row.episode_count for row in statistics.get_character_statistics(db, limit=1000)
+    } == {character.id: episodes_per_character[character.id] for character in characters}
+
+    episodes_per_season = Counter(season_number for season_number, in db.query(Episode.season_number))
+    assert dict(statistics.get_season_statistics(db)) == episodes_per_season
+
+    for field in statistics.DISTRIBUTION_FIELDS:
+        distribution = Counter(
+            getattr(getattr(character, field), "value", getattr(character, field)) for character in characters
+        )
+        assert dict(statistics.get_character_distribution(db, field)) == distribution
+
+    assert [row.episode_id for row in statistics.get_episode_statistics(db, ids="3,1")] == [3, 1]
+    db.close()
+
+
+
+def test_null_and_empty_values_are_one_distribution_row():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "INSERT INTO characters (id, name, status, species, gender) VALUES (?, ?, 'alive', ?, 'male')",
+            [(1, "No species", None), (2, "Empty species", ""), (3, "Human", "Human")]
+        )
+        statistics.build_statistics(connection)
+
+    db = sessionmaker(bind=engine)()
+    assert dict(statistics.get_character_distribution(db, "species")) == {"": 2, "Human": 1}
+    db.close()